@@ -1,30 +1,90 @@
 import os
-import io
 import logging
-import requests
 import json
 import datetime
 import secrets
-from flask import Flask, render_template, request, session, jsonify, redirect, url_for, flash, send_file
-from flask_session import Session
-from PIL import Image
-import stripe
+import threading
+import time
+import tempfile
+import zipfile
+from flask import Flask, Response, g, render_template, request, session, jsonify, redirect, url_for, flash, send_file, stream_with_context
 from werkzeug.utils import secure_filename
+import blob_store
+import checkout_cache
+import payment_store
+import metrics
+import result_cache
+from stripe_client import StripeUnavailableError, call_stripe, checkout_idempotency_key, configure_stripe, get_stripe
+from upload_ingest import IngestRequest, UploadRejected
+from logging_config import configure_logging
+from session_store import init_session
+from image_processing import BLS_MAX_BYTES, InvalidImageError, allowed_image_filename, inspect_image, processing_params
+from jobs import QueueFullError, submit_photo_job, create_finished_job, get_job_status, has_capacity, iter_finished_jobs
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (LOG_LEVEL, LOG_FORMAT and LOG_SAMPLE_RATE come from the environment)
+configure_logging()
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = IngestRequest
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
 
-# Configure session to use filesystem
-app.config["SESSION_TYPE"] = "filesystem"
+# Configure the session backend (hybrid: signed cookie plus a server-side SQLite store)
 app.config["SESSION_PERMANENT"] = False
-Session(app)
+app.config["SESSION_SQLITE_PATH"] = os.environ.get("SESSION_SQLITE_PATH", os.path.join("sessions", "sessions.db"))
+init_session(app, os.environ.get("SESSION_BACKEND", "hybrid"))
 
-# Configure Stripe
-stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
+# Time session writes for the metrics endpoint
+_save_session = app.session_interface.save_session
+def timed_save_session(*args, **kwargs):
+    with metrics.timer("session_save_seconds"):
+        return _save_session(*args, **kwargs)
+app.session_interface.save_session = timed_save_session
+
+# Maximum size of the processed photo (BLS Canada allows 240 KB)
+app.config["PHOTO_MAX_BYTES"] = int(os.environ.get("PHOTO_MAX_KB", BLS_MAX_BYTES // 1024)) * 1024
+
+# Previews are content-addressed, so browsers may keep them for a long time
+app.config["PREVIEW_CACHE_SECONDS"] = int(os.environ.get("PREVIEW_CACHE_SECONDS", 86400))
+
+# Upload limits: single uploads are capped below batches, and parts spill to disk past the memory limit
+app.config["UPLOAD_MAX_BYTES"] = int(os.environ.get("UPLOAD_MAX_MB", 15)) * 1024 * 1024
+app.config["UPLOAD_MEMORY_LIMIT"] = int(os.environ.get("UPLOAD_MEMORY_KB", 1024)) * 1024
+
+# Limits for /batch-upload
+app.config["BATCH_MAX_IMAGES"] = int(os.environ.get("BATCH_MAX_IMAGES", 20))
+app.config["BATCH_MAX_BYTES"] = int(os.environ.get("BATCH_MAX_MB", 100)) * 1024 * 1024
+app.config["BATCH_TIMEOUT_SECONDS"] = int(os.environ.get("BATCH_TIMEOUT_SECONDS", 120))
+
+# Bodies larger than any route accepts are refused from Content-Length alone
+app.config["MAX_CONTENT_LENGTH"] = max(app.config["UPLOAD_MAX_BYTES"], app.config["BATCH_MAX_BYTES"])
+
+# Feedback entries shown per admin page
+app.config["FEEDBACK_PAGE_SIZE"] = int(os.environ.get("FEEDBACK_PAGE_SIZE", 50))
+
+# Bearer token required by /metrics (unset leaves it open for internal scrapers)
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+# Create checkout sessions in the background after uploads that will need payment,
+# and how long a pay click waits for such a creation before starting its own
+app.config["CHECKOUT_PREWARM"] = os.environ.get("CHECKOUT_PREWARM", "0") == "1"
+app.config["CHECKOUT_WARM_WAIT_SECONDS"] = float(os.environ.get("CHECKOUT_WARM_WAIT_SECONDS", 5))
+
+# Signing secret of the Stripe webhook endpoint; when set, only webhook-confirmed payments count
+app.config["STRIPE_WEBHOOK_SECRET"] = os.environ.get("STRIPE_WEBHOOK_SECRET")
+
+# How long one /payment-events connection waits before the browser reconnects
+app.config["PAYMENT_EVENTS_TIMEOUT_SECONDS"] = int(os.environ.get("PAYMENT_EVENTS_TIMEOUT_SECONDS", 25))
+
+# Open /payment-events streams per worker process; each one holds a worker thread,
+# so past this many the endpoint answers at once and the browser polls instead
+app.config["PAYMENT_EVENTS_MAX_STREAMS"] = int(os.environ.get("PAYMENT_EVENTS_MAX_STREAMS", 4))
+
+# How long the browser waits before reconnecting when no stream slot was free
+app.config["PAYMENT_EVENTS_BUSY_RETRY_MS"] = int(os.environ.get("PAYMENT_EVENTS_BUSY_RETRY_MS", 3000))
+
+# Configure Stripe (STRIPE_API_BASE points at a local stub for load tests)
+configure_stripe(os.environ.get("STRIPE_SECRET_KEY"), os.environ.get("STRIPE_API_BASE"))
 
 # Get the domain from Replit's environment variables
 REPLIT_DOMAIN = os.environ.get('REPLIT_DOMAINS', '').split(',')[0] if os.environ.get('REPLIT_DOMAINS') else None
@@ -40,13 +100,15 @@ else:
     PROTOCOL = "http"
 
 # Log the domain being used for debugging
-logging.info(f"Using domain: {YOUR_DOMAIN} with protocol: {PROTOCOL}")
+logging.info("Using domain: %s with protocol: %s", YOUR_DOMAIN, PROTOCOL)
 
 @app.route('/')
 def index():
     # Always reset payment status on index page load
     if 'paid' in session:
         session['paid'] = False
+        # Forget the paid checkout too, so its webhook confirmation isn't applied again
+        session.pop('checkout_session_id', None)
         logging.info("Reset paid status to False on index page")
     
     # Initialize download counter if not present
@@ -56,6 +118,20 @@ def index():
     
     return render_template('index.html')
 
+def start_photo_job(upload):
+    """Start processing a validated upload (a seekable binary file) and return (job_id, cached)"""
+    # Re-uploads of the same photo with the same settings reuse the stored result
+    max_bytes = app.config["PHOTO_MAX_BYTES"]
+    cache_key = result_cache.make_key(upload, processing_params(max_bytes))
+    cached = result_cache.get(cache_key)
+    metrics.inc("result_cache_lookups_total", result="hit" if cached is not None else "miss")
+    if cached is not None:
+        logging.debug("Result cache hit, skipping image processing")
+        return create_finished_job(cached), True
+    
+    # Hand the CPU-heavy work to the processing pool and return straight away
+    return submit_photo_job(upload, max_bytes, cache_key), False
+
 @app.route('/upload', methods=['POST'])
 def upload_image():
     # Generate CSRF token if not present
@@ -66,85 +142,354 @@ def upload_image():
     if not request.content_type or 'multipart/form-data' not in request.content_type:
         return jsonify({"error": "Invalid content type"}), 400
     
-    if 'image' not in request.files:
+    # Parsing the body streams the upload; a bad image header stops it early
+    request.max_content_length = app.config["UPLOAD_MAX_BYTES"]
+    try:
+        files = request.files
+    except UploadRejected as rejected:
+        logging.error("Image validation failed: %s", rejected)
+        return jsonify({"error": str(rejected)}), 400
+    
+    if 'image' not in files:
         return jsonify({"error": "No file part"}), 400
     
-    file = request.files['image']
+    file = files['image']
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     
     # Validate file extension
-    allowed_extensions = {'jpg', 'jpeg', 'png'}
-    if not ('.' in file.filename and file.filename.rsplit('.', 1)[1].lower() in allowed_extensions):
+    if not allowed_image_filename(file.filename):
         return jsonify({"error": "Invalid file type. Only JPG and PNG are allowed"}), 400
     
     if file:
         try:
-            # Sanitize the filename and generate a random name to prevent path traversal
-            random_filename = f"{secrets.token_hex(8)}.jpg"
-            
-            # Open the image with PIL to validate it's actually an image
+            # Validate format and dimensions from the header before decoding any pixels;
+            # the spooled upload is hashed and copied in chunks, never read whole
             try:
-                image = Image.open(file)
-                
-                # Basic image validation
-                if image.format not in ['JPEG', 'PNG']:
-                    return jsonify({"error": "Invalid image format"}), 400
-                
-                # Check for reasonable dimensions before processing
-                if image.width > 5000 or image.height > 5000:
-                    return jsonify({"error": "Image dimensions are too large"}), 400
-            except Exception as img_err:
-                logging.error(f"Image validation failed: {str(img_err)}")
-                return jsonify({"error": "Invalid image file"}), 400
-            
-            # Resize to 600x600
-            resized_image = image.resize((600, 600))
+                inspect_image(file.stream)
+            except InvalidImageError as img_err:
+                logging.error("Image validation failed: %s", img_err)
+                return jsonify({"error": str(img_err)}), 400
             
-            # Check file size and compress if necessary
-            buf_check = io.BytesIO()
-            resized_image.save(buf_check, format="JPEG", quality=95)
-            file_size_kb = len(buf_check.getvalue()) / 1024
-            
-            compression_info = {}
-            if file_size_kb > 240:
-                compression_info["warning"] = f"Original resized photo is {round(file_size_kb, 2)} KB, exceeding BLS Canada's 240 KB max. Attempting compression..."
-                for quality in range(90, 10, -10):
-                    compressed_buf = io.BytesIO()
-                    resized_image.save(compressed_buf, format="JPEG", quality=quality)
-                    compressed_size_kb = len(compressed_buf.getvalue()) / 1024
-                    if compressed_size_kb <= 240:
-                        resized_image = Image.open(io.BytesIO(compressed_buf.getvalue()))
-                        compression_info["success"] = f"Compressed image to {round(compressed_size_kb, 2)} KB using quality={quality}."
-                        break
-                else:
-                    compression_info["error"] = "Unable to compress under 240 KB even at low quality. Consider uploading a simpler image."
+            try:
+                job_id, cached = start_photo_job(file.stream)
+            except QueueFullError as queue_err:
+                logging.warning("Processing queue full, rejecting upload")
+                return jsonify({"error": str(queue_err)}), 503
             
-            # Save the processed image to session - don't store actual file paths
-            buffered = io.BytesIO()
-            resized_image.save(buffered, format="JPEG")
-            session['processed_image'] = buffered.getvalue()
+            session['upload_job_id'] = job_id
             
-            # Generate a small preview image
-            small_preview = resized_image.resize((150, 150))
-            preview_buffered = io.BytesIO()
-            small_preview.save(preview_buffered, format="JPEG")
-            preview_data = preview_buffered.getvalue()
-            import base64
-            preview_b64 = base64.b64encode(preview_data).decode('utf-8')
+            # Once the free download is used, the next one needs payment: create
+            # the checkout now so the pay click doesn't wait on Stripe
+            if app.config["CHECKOUT_PREWARM"] and session.get('download_count', 0) >= 1 and not session.get('paid'):
+                checkout_cache.warm(checkout_reference(), CHECKOUT_PRODUCT, create_checkout)
             
             return jsonify({
-                "message": "Image processed successfully",
-                "preview": f"data:image/jpeg;base64,{preview_b64}",
-                "compression_info": compression_info,
+                "message": "Image queued for processing",
+                "job_id": job_id,
+                "cached": cached,
+                "status_url": url_for('job_status', job_id=job_id),
+                "result_url": url_for('job_result', job_id=job_id),
                 "csrf_token": session['csrf_token']
-            })
+            }), 202
         except Exception as e:
-            logging.error(f"Error processing image: {str(e)}")
+            logging.error("Error processing image: %s", e)
             return jsonify({"error": f"Error processing image: {str(e)}"}), 500
     
     return jsonify({"error": "Invalid file"}), 400
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the processing status of the current upload"""
+    # Only the session that uploaded the image may see its job
+    if job_id != session.get('upload_job_id'):
+        return jsonify({"error": "Job not found"}), 404
+    
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    response = {"job_id": job_id, "status": status["status"]}
+    if status["status"] == "done":
+        response["result_url"] = url_for('job_result', job_id=job_id)
+    elif status["status"] == "failed":
+        response["error"] = status.get("error", "Error processing image")
+    return jsonify(response)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Return the processed image preview once the job has finished"""
+    if job_id != session.get('upload_job_id'):
+        return jsonify({"error": "Job not found"}), 404
+    
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    if status["status"] == "pending":
+        return jsonify({"job_id": job_id, "status": "pending"}), 202
+    if status["status"] == "failed":
+        return jsonify({"error": status.get("error", "Error processing image")}), 500
+    
+    if blob_store.blob_path(status["preview_id"]) is None or blob_store.blob_path(status["image_id"]) is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    # The session only references the stored images - never the bytes or a file path
+    if session.get('processed_image_id') != status["image_id"]:
+        session['processed_image_id'] = status["image_id"]
+        session['preview_id'] = status["preview_id"]
+    
+    return jsonify({
+        "message": "Image processed successfully",
+        "preview": url_for('preview', preview_id=status["preview_id"]),
+        "compression_info": status["compression_info"],
+        "compliance": status.get("compliance"),
+        "csrf_token": session.get('csrf_token')
+    })
+
+@app.route('/preview/<preview_id>')
+def preview(preview_id):
+    """Serve the preview JPEG; the id is its content hash, so it doubles as a strong ETag"""
+    if preview_id != session.get('preview_id'):
+        return jsonify({"error": "Preview not found"}), 404
+    
+    preview_path = blob_store.blob_path(preview_id)
+    if preview_path is None:
+        return jsonify({"error": "Preview not found"}), 404
+    
+    # send_file answers If-None-Match with 304 when the ETag matches
+    response = send_file(
+        preview_path,
+        mimetype='image/jpeg',
+        etag=preview_id,
+        conditional=True,
+        max_age=app.config["PREVIEW_CACHE_SECONDS"]
+    )
+    # Previews are personal photos, so only the browser may cache them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/batch-upload', methods=['POST'])
+def batch_upload():
+    """Process several photos in one request, streaming NDJSON results as each finishes"""
+    if 'csrf_token' not in session:
+        session['csrf_token'] = secrets.token_hex(16)
+    
+    if not request.content_type or 'multipart/form-data' not in request.content_type:
+        return jsonify({"error": "Invalid content type"}), 400
+    
+    # Collect (filename, size, open function) for the uploaded files and/or a zip archive.
+    # Nothing is read into memory: files stay spooled and zip members are streamed
+    max_images = app.config["BATCH_MAX_IMAGES"]
+    max_bytes = app.config["BATCH_MAX_BYTES"]
+    uploads = []
+    zf = None
+    request.max_content_length = max_bytes
+    try:
+        for file in request.files.getlist('images'):
+            if file.filename:
+                file.stream.seek(0, os.SEEK_END)
+                uploads.append((file.filename, file.stream.tell(), lambda file=file: file.stream))
+        
+        archive = request.files.get('archive')
+        if archive and archive.filename:
+            zf = zipfile.ZipFile(archive.stream)
+            members = [m for m in zf.infolist() if not m.is_dir() and allowed_image_filename(m.filename)]
+            # Check declared sizes first so a zip bomb is never expanded
+            if len(uploads) + len(members) > max_images or sum(m.file_size for m in members) > max_bytes:
+                zf.close()
+                return jsonify({"error": f"A batch may contain at most {max_images} images"}), 400
+            for member in members:
+                uploads.append((os.path.basename(member.filename), member.file_size, lambda member=member: zf.open(member)))
+    except zipfile.BadZipFile:
+        return jsonify({"error": "Invalid zip archive"}), 400
+    except UploadRejected as rejected:
+        return jsonify({"error": str(rejected)}), 400
+    
+    try:
+        if not uploads:
+            return jsonify({"error": "No images provided"}), 400
+        if len(uploads) > max_images or sum(size for _, size, _ in uploads) > max_bytes:
+            return jsonify({"error": f"A batch may contain at most {max_images} images"}), 400
+        if not has_capacity(len(uploads)):
+            logging.warning("Processing queue full, rejecting batch upload")
+            return jsonify({"error": "Too many images are being processed. Please try again shortly."}), 503
+        
+        # Validate and queue everything up front so the pool works on all images in parallel
+        lines = []
+        job_indexes = {}
+        for index, (filename, _, open_upload) in enumerate(uploads):
+            line = {"index": index, "filename": filename}
+            try:
+                if not allowed_image_filename(filename):
+                    raise InvalidImageError("Invalid file type. Only JPG and PNG are allowed")
+                upload = open_upload()
+                inspect_image(upload)
+                job_id, _ = start_photo_job(upload)
+                job_indexes[job_id] = index
+            except (InvalidImageError, QueueFullError, zipfile.BadZipFile) as e:
+                line.update(status="failed", error=str(e))
+            lines.append(line)
+    finally:
+        if zf is not None:
+            zf.close()
+    
+    batch_id = secrets.token_hex(8)
+    session['batch_id'] = batch_id
+    session['batch_jobs'] = [[job_id, lines[index]["filename"]] for job_id, index in job_indexes.items()]
+    timeout = app.config["BATCH_TIMEOUT_SECONDS"]
+    csrf_token = session['csrf_token']
+    
+    def generate():
+        for line in lines:
+            if line.get("status") == "failed":
+                yield json.dumps(line) + "\n"
+        try:
+            for job_id in iter_finished_jobs(list(job_indexes), timeout=timeout):
+                line = lines[job_indexes.pop(job_id)]
+                status = get_job_status(job_id) or {"status": "failed", "error": "Job not found"}
+                line.update(job_id=job_id, status=status["status"])
+                if status["status"] == "done":
+                    line["compression_info"] = status["compression_info"]
+                    line["compliance"] = status.get("compliance")
+                else:
+                    line["error"] = status.get("error", "Error processing image")
+                yield json.dumps(line) + "\n"
+        except TimeoutError:
+            for index in job_indexes.values():
+                yield json.dumps(dict(lines[index], status="failed", error="Processing timed out")) + "\n"
+        yield json.dumps({"batch_id": batch_id, "download_url": url_for('batch_download', batch_id=batch_id), "csrf_token": csrf_token}) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def finished_batch_images():
+    """(zip entry name, image path) of each finished photo in this session's batch.
+    
+    Failed or unfinished jobs are left out, so a batch is only ever charged
+    for the photos its zip actually contains.
+    """
+    entries = []
+    for position, (job_id, filename) in enumerate(session.get('batch_jobs', []), start=1):
+        status = get_job_status(job_id)
+        image_path = blob_store.blob_path(status.get("image_id")) if status else None
+        if image_path is not None:
+            stem = secure_filename(filename.rsplit('.', 1)[0]) or "photo"
+            entries.append((f"{position:02d}_{stem}.jpg", image_path))
+    return entries
+
+@app.route('/batch/<batch_id>/download')
+def batch_download(batch_id):
+    """Download every processed photo of a batch as one zip file"""
+    if batch_id != session.get('batch_id'):
+        flash("No processed batch found. Please upload your photos first.")
+        return redirect(url_for('index'))
+    
+    entries = finished_batch_images()
+    if not entries:
+        flash("None of the photos in this batch are ready yet.")
+        return redirect(url_for('index'))
+    
+    # Every photo in the zip counts as a download
+    allowed, _ = claim_download(len(entries))
+    if not allowed:
+        return redirect(url_for('index'))
+    
+    # JPEGs don't compress further, so store them without deflate
+    archive = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for name, path in entries:
+            zf.write(path, arcname=name)
+    archive.seek(0)
+    
+    return send_file(
+        archive,
+        mimetype='application/zip',
+        as_attachment=True,
+        download_name='bls_photos.zip'
+    )
+
+# What a premium download costs, per photo; cached checkouts are keyed on
+# the product, which names the number of photos for batch purchases
+CHECKOUT_PRODUCT = "premium_download"
+CHECKOUT_UNIT_AMOUNT = 299
+
+def checkout_product(quantity=1):
+    """Checkout cache product name for a purchase of quantity photos"""
+    return CHECKOUT_PRODUCT if quantity == 1 else f"{CHECKOUT_PRODUCT}_x{quantity}"
+
+def checkout_line_items(quantity=1):
+    return [{
+        "price_data": {
+            "currency": "cad",
+            "product_data": {
+                "name": "PhotoPass Premium Download",
+                "description": "BLS Canada Compliant Passport/OCI/Visa Photo (600x600)"
+            },
+            "unit_amount": CHECKOUT_UNIT_AMOUNT
+        },
+        "quantity": quantity,
+    }]
+
+def checkout_reference(quantity=1):
+    """Return this session's checkout reference, starting a new one if its cached checkout is expiring.
+    
+    The reference also keys the idempotency key, so keeping it after expiry
+    (or for a different number of photos) would make Stripe replay the old
+    checkout.
+    """
+    product = checkout_product(quantity)
+    reference = session.get('checkout_reference')
+    if reference is not None and session.get('checkout_quantity', 1) == quantity:
+        cached = checkout_cache.get(reference, product)
+        if cached is None or checkout_cache.is_reusable(cached):
+            return reference
+    if reference is not None:
+        checkout_cache.invalidate(reference)
+    session['checkout_reference'] = secrets.token_hex(16)
+    session['checkout_quantity'] = quantity
+    return session['checkout_reference']
+
+def clear_checkout_reference():
+    """Drop this session's checkout reference and its cached checkout (after payment or expiry)"""
+    reference = session.pop('checkout_reference', None)
+    if reference is not None:
+        checkout_cache.invalidate(reference)
+
+def mark_paid():
+    """Record a completed payment in the session; the paid checkout can't be reused"""
+    session['paid'] = True
+    # A batch checkout pays for each of its photos
+    session['paid_photos'] = session.pop('checkout_quantity', 1)
+    clear_checkout_reference()
+
+def payment_confirmed():
+    """Whether this session has paid, picking up payments confirmed by webhook"""
+    if session.get('paid', False):
+        return True
+    if payment_store.is_paid(session.get('checkout_session_id')):
+        mark_paid()
+        return True
+    return False
+
+def create_checkout(reference, quantity=1):
+    """Create a Stripe checkout session for reference and quantity photos, and cache it.
+    
+    Runs outside the request context when warming, so it must not touch the session.
+    """
+    # Retries and repeated creations for the same reference reuse one idempotency key
+    checkout_session = call_stripe(
+        get_stripe().checkout.Session.create,
+        payment_method_types=["card"],
+        line_items=checkout_line_items(quantity),
+        mode="payment",
+        client_reference_id=reference,
+        idempotency_key=checkout_idempotency_key(reference),
+        success_url=f"{PROTOCOL}://{YOUR_DOMAIN}/success",
+        cancel_url=f"{PROTOCOL}://{YOUR_DOMAIN}/cancel"
+    )
+    return checkout_cache.put(reference, checkout_product(quantity), checkout_session)
+
 @app.route('/create-checkout-session', methods=['POST'])
 def create_checkout_session():
     try:
@@ -155,53 +500,55 @@ def create_checkout_session():
             return jsonify({"error": "Invalid security token"}), 403
         
         # Check if user has a processed image - don't allow checkout without it
-        if 'processed_image' not in session:
+        if blob_store.blob_path(session.get('processed_image_id')) is None and 'batch_id' not in session:
             return jsonify({"error": "No processed image found. Please upload an image first."}), 400
         
         # Log the domain we're using for debugging (without revealing full domain details in logs)
-        logging.info(f"Creating checkout session with domain: {YOUR_DOMAIN}")
-        logging.info(f"Protocol: {PROTOCOL}")
-        logging.info(f"Full URL will be: {PROTOCOL}://{YOUR_DOMAIN}/success")
+        logging.info("Creating checkout session with domain: %s", YOUR_DOMAIN)
+        logging.info("Protocol: %s", PROTOCOL)
+        logging.info("Full URL will be: %s://%s/success", PROTOCOL, YOUR_DOMAIN)
         
         # Reset the 'paid' flag if it exists to avoid conflicts
         session['paid'] = False
         
-        # Generate a checkout session with proper metadata
+        # A batch is paid per finished photo (the ones its zip will hold); pay for
+        # it when asked to, or when there is no single photo
+        quantity = 1
+        if 'batch_id' in session and (request.form.get('batch_id') == session['batch_id']
+                                      or blob_store.blob_path(session.get('processed_image_id')) is None):
+            quantity = len(finished_batch_images())
+            if quantity == 0:
+                return jsonify({"error": "None of the photos in this batch are ready yet."}), 400
+        
+        # Reuse this session's open checkout when there is one, waiting briefly
+        # for a background creation started after upload
+        reference = checkout_reference(quantity)
+        product = checkout_product(quantity)
+        checkout_cache.wait_for_warm(reference, product, app.config["CHECKOUT_WARM_WAIT_SECONDS"])
+        checkout_session = checkout_cache.get(reference, product)
+        metrics.inc("checkout_cache_lookups_total", result="hit" if checkout_session is not None else "miss")
         try:
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=["card"],
-                line_items=[{
-                    "price_data": {
-                        "currency": "cad",
-                        "product_data": {
-                            "name": "PhotoPass Premium Download",
-                            "description": "BLS Canada Compliant Passport/OCI/Visa Photo (600x600)"
-                        },
-                        "unit_amount": 299
-                    },
-                    "quantity": 1,
-                }],
-                mode="payment",
-                client_reference_id=secrets.token_hex(16),  # Generate random reference ID
-                success_url=f"{PROTOCOL}://{YOUR_DOMAIN}/success",
-                cancel_url=f"{PROTOCOL}://{YOUR_DOMAIN}/cancel"
-            )
+            if checkout_session is None:
+                checkout_session = create_checkout(reference, quantity)
             
             # Store minimal info in session - only the ID
-            session['checkout_session_id'] = checkout_session.id
+            session['checkout_session_id'] = checkout_session["id"]
             
             # Generate new CSRF token for next request
             session['csrf_token'] = secrets.token_hex(16)
             
             return jsonify({
-                "url": checkout_session.url,
+                "url": checkout_session["url"],
                 "csrf_token": session['csrf_token']
             })
+        except StripeUnavailableError as stripe_error:
+            logging.error("Stripe API timeout: %s", stripe_error)
+            return jsonify({"error": "Payment processor is not responding. Please try again."}), 503
         except Exception as stripe_error:
-            logging.error(f"Stripe API Error: {str(stripe_error)}")
+            logging.error("Stripe API Error: %s", stripe_error)
             return jsonify({"error": f"Payment processor error: {str(stripe_error)}"}), 500
     except Exception as e:
-        logging.error(f"Error creating checkout session: {str(e)}")
+        logging.error("Error creating checkout session: %s", e)
         # Don't return the exact error to the client to avoid leaking implementation details
         return jsonify({"error": "Unable to create payment session. Please try again later."}), 500
 
@@ -220,21 +567,25 @@ def reset_session():
 
 @app.route('/success', methods=['GET', 'POST'])
 def success():
-    # Mark the payment as successful in the session
-    session['paid'] = True
-    logging.info("Payment success route accessed, setting session['paid'] = True")
-    
-    # Check if we have the checkout session ID
     checkout_id = session.get('checkout_session_id', 'unknown')
     
+    # With webhooks configured the redirect alone proves nothing: the payment
+    # counts once Stripe confirms it (the page then waits on /payment-events)
+    if app.config["STRIPE_WEBHOOK_SECRET"]:
+        paid = payment_confirmed()
+        logging.info("Payment success route accessed for checkout session %s, confirmed: %s", checkout_id, paid)
+    else:
+        mark_paid()
+        paid = True
+        logging.info("Payment success route accessed, setting session['paid'] = True")
+    
     # When a user completes payment via Stripe, they are redirected here
-    logging.info(f"SUCCESS - Payment completed for checkout session: {checkout_id}")
-    logging.info(f"Current session state: download_count={session.get('download_count', 0)}, paid={session.get('paid', True)}")
+    logging.info("Current session state: download_count=%s, paid=%s", session.get('download_count', 0), paid)
     
     # If this is a POST request, just confirm the payment was received
     if request.method == 'POST':
         logging.info("Received POST confirmation to /success route")
-        return jsonify({"status": "payment_confirmed", "checkout_id": checkout_id})
+        return jsonify({"status": "payment_confirmed" if paid else "payment_pending", "checkout_id": checkout_id})
     
     # For GET requests, show the success page
     return render_template('success.html')
@@ -243,11 +594,45 @@ def success():
 def cancel():
     return render_template('cancel.html')
 
+def claim_download(photos=1):
+    """Apply the free/paid download rules to a download of photos photos and count it if it is allowed.
+    
+    The free download covers one photo; a payment covers as many photos as
+    were bought. Returns (allowed, free_download).
+    """
+    # Determine if this should be free or paid
+    free_download = session.get('download_count', 0) + photos <= 1
+    has_paid = payment_confirmed()
+    
+    logging.info("Download permission check - Free download available: %s, Has paid: %s", free_download, has_paid)
+    
+    # If they've already used their free download and haven't paid, redirect to payment
+    if not free_download and not has_paid:
+        if photos > 1:
+            flash(f"Downloading these {photos} photos needs payment for each of them.")
+        else:
+            flash("You've used your free download. Please complete payment for additional downloads.")
+        logging.info("Download blocked: User has already used free download and hasn't paid")
+        return False, free_download
+    
+    # A payment only covers the number of photos that were bought
+    if not free_download and session.get('paid_photos', 1) < photos:
+        flash(f"Your payment covers {session.get('paid_photos', 1)} photo(s); this download has {photos}. Please pay for the whole batch.")
+        logging.info("Download blocked: %s photo(s) requested, %s paid for", photos, session.get('paid_photos', 1))
+        return False, free_download
+    
+    # At this point, download is allowed
+    # Increment download counter BEFORE sending the file
+    current_count = session.get('download_count', 0)
+    session['download_count'] = current_count + photos
+    logging.info("Download allowed: Incremented download counter from %s to %s", current_count, current_count + photos)
+    return True, free_download
+
 @app.route('/download')
 def download():
     # Log download attempt for debugging
     logging.info("==== DOWNLOAD ATTEMPT ====")
-    logging.info(f"Session state - download_count: {session.get('download_count', 0)}, paid: {session.get('paid', False)}")
+    logging.info("Session state - download_count: %s, paid: %s", session.get('download_count', 0), session.get('paid', False))
     
     # Initialize download counter if not present
     if 'download_count' not in session:
@@ -255,32 +640,18 @@ def download():
         logging.info("Initialized download counter to 0")
     
     # Check if we have an image to download
-    if 'processed_image' not in session:
+    image_path = blob_store.blob_path(session.get('processed_image_id'))
+    if image_path is None:
         flash("No processed image found. Please upload an image first.")
         logging.info("Download failed: No processed image found")
         return redirect(url_for('index'))
     
-    # Determine if this should be free or paid
-    free_download = session.get('download_count', 0) < 1
-    has_paid = session.get('paid', False)
-    
-    logging.info(f"Download permission check - Free download available: {free_download}, Has paid: {has_paid}")
-    
-    # If they've already used their free download and haven't paid, redirect to payment
-    if not free_download and not has_paid:
-        flash("You've used your free download. Please complete payment for additional downloads.")
-        logging.info("Download blocked: User has already used free download and hasn't paid")
+    allowed, free_download = claim_download()
+    if not allowed:
         return redirect(url_for('index'))
     
-    # At this point, download is allowed
-    # Increment download counter BEFORE sending the file
-    current_count = session.get('download_count', 0)
-    session['download_count'] = current_count + 1
-    logging.info(f"Download allowed: Incremented download counter from {current_count} to {current_count + 1}")
-    
-    # Create a BytesIO object from the stored image
-    img_io = io.BytesIO(session['processed_image'])
-    img_io.seek(0)
+    # Keep the stored image alive while the session is using it
+    blob_store.touch(session['processed_image_id'])
     
     # Log clear download status
     if free_download:
@@ -289,14 +660,14 @@ def download():
         logging.info("PAID DOWNLOAD provided to user")
     
     return send_file(
-        img_io,
+        image_path,
         mimetype='image/jpeg',
         as_attachment=True,
         download_name='bls_photo.jpg'
     )
 
 def save_feedback_to_file(name, feedback, email=None, timestamp=None):
-    """Save feedback data to a local JSON file"""
+    """Save feedback data to the local feedback store"""
     # Create timestamp if not provided
     if not timestamp:
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -310,35 +681,16 @@ def save_feedback_to_file(name, feedback, email=None, timestamp=None):
     }
     
     try:
-        # Ensure the feedback directory exists
-        os.makedirs('feedback', exist_ok=True)
-        
-        # Save to a JSON file in the feedback directory
-        feedback_file = os.path.join('feedback', 'feedback_records.json')
-        
-        # Read existing feedback if file exists
-        if os.path.exists(feedback_file):
-            try:
-                with open(feedback_file, 'r') as f:
-                    all_feedback = json.load(f)
-            except json.JSONDecodeError:
-                # If file is corrupted, start with empty list
-                all_feedback = []
-        else:
-            all_feedback = []
-        
-        # Add new feedback to the list
-        all_feedback.append(feedback_data)
-        
-        # Write the updated feedback list back to the file
-        with open(feedback_file, 'w') as f:
-            json.dump(all_feedback, f, indent=2)
+        # Imported here: feedback is rare and shouldn't cost every worker's startup
+        from feedback_store import add_feedback
         
-        logging.info(f"Feedback saved to file: {feedback_file}")
+        # Append to the feedback store; no read-modify-write of earlier records
+        add_feedback(feedback_data)
+        logging.info("Feedback saved to feedback store")
         return True
     
     except Exception as e:
-        logging.error(f"Error saving feedback to file: {str(e)}")
+        logging.error("Error saving feedback to file: %s", e)
         return False
 
 @app.route('/submit-feedback', methods=['POST'])
@@ -374,7 +726,7 @@ def submit_feedback():
             email = email.replace('<', '&lt;').replace('>', '&gt;')
         
         # Log the feedback with sanitized values
-        logging.info(f"Feedback received - Name: {name}, Email: {email and email[:3] + '***' or 'Not provided'}")
+        logging.info("Feedback received - Name: %s, Email: %s", name, email and email[:3] + '***' or 'Not provided')
         
         # Save feedback to a file using our helper function
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -397,7 +749,7 @@ def submit_feedback():
         })
         
     except Exception as e:
-        logging.error(f"Error submitting feedback: {str(e)}")
+        logging.error("Error submitting feedback: %s", e)
         return jsonify({"error": "An error occurred while processing your feedback"}), 500
 
 @app.route('/feedback-confirmation')
@@ -431,25 +783,34 @@ def admin_logout():
         session.pop('admin_authenticated')
     return redirect(url_for('index'))
 
+@app.route('/admin/cache-stats')
+def cache_stats():
+    """Report result cache hit/miss counters for this worker"""
+    if not session.get('admin_authenticated'):
+        return jsonify({"error": "Authentication required"}), 403
+    return jsonify(result_cache.get_stats())
+
 @app.route('/admin/feedback', methods=['GET', 'POST'])
 def view_feedback():
     """Admin page to view all feedback submissions with password protection"""
     # Check if user is already authenticated
     if session.get('admin_authenticated'):
         try:
-            feedback_file = os.path.join('feedback', 'feedback_records.json')
-            if os.path.exists(feedback_file):
-                with open(feedback_file, 'r') as f:
-                    feedback_data = json.load(f)
-                
-                # Sort feedback by timestamp (newest first)
-                feedback_data.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-                
-                return render_template('admin_feedback.html', feedback=feedback_data)
+            from feedback_store import get_feedback_page
+            
+            # Read only the requested page, newest first
+            page = request.args.get('page', 1, type=int)
+            per_page = app.config["FEEDBACK_PAGE_SIZE"]
+            feedback_data, total = get_feedback_page(page, per_page)
+            total_pages = max((total + per_page - 1) // per_page, 1)
+            
+            if total:
+                return render_template('admin_feedback.html', feedback=feedback_data,
+                                       page=page, total_pages=total_pages, total=total)
             else:
                 return render_template('admin_feedback.html', feedback=[], error="No feedback found")
         except Exception as e:
-            logging.error(f"Error viewing feedback: {str(e)}")
+            logging.error("Error viewing feedback: %s", e)
             return render_template('admin_feedback.html', feedback=[], error=str(e))
     
     # If not authenticated, show login form
@@ -466,6 +827,11 @@ def view_feedback():
 @app.route('/direct-payment', methods=['POST'])
 def direct_payment():
     """Process direct payment (for testing in Replit environment)"""
+    # Once webhooks confirm payments, a bare POST must not be able to mark a session paid
+    if app.config["STRIPE_WEBHOOK_SECRET"]:
+        logging.warning("Direct payment refused: payments are confirmed by Stripe webhooks")
+        return jsonify({"error": "Not found"}), 404
+    
     # Validate CSRF token
     csrf_token = request.form.get('csrf_token', '')
     if not csrf_token or csrf_token != session.get('csrf_token', ''):
@@ -473,7 +839,7 @@ def direct_payment():
         return jsonify({"error": "Invalid security token"}), 403
     
     # Mark the payment as successful
-    session['paid'] = True
+    mark_paid()
     logging.info("Direct payment processed, setting session['paid'] = True")
     
     # Return success with updated CSRF token
@@ -495,15 +861,144 @@ def payment_status():
     
     # Return current payment status with CSRF token
     return jsonify({
-        "paid": session.get('paid', False),
+        "paid": payment_confirmed(),
         "download_count": download_count,
         "free_download_available": free_download_available,
         "csrf_token": session.get('csrf_token')
     })
 
+# Stripe events that mean a checkout session has been paid for
+PAID_CHECKOUT_EVENTS = {"checkout.session.completed", "checkout.session.async_payment_succeeded"}
+
+@app.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    """Record payments confirmed by Stripe; the signature proves the event came from Stripe"""
+    secret = app.config["STRIPE_WEBHOOK_SECRET"]
+    if not secret:
+        logging.error("Stripe webhook received but STRIPE_WEBHOOK_SECRET is not set")
+        return jsonify({"error": "Webhooks are not configured"}), 503
+    
+    stripe = get_stripe()
+    try:
+        event = stripe.Webhook.construct_event(request.get_data(), request.headers.get('Stripe-Signature', ''), secret)
+    except ValueError:
+        metrics.inc("stripe_webhooks_total", outcome="invalid")
+        return jsonify({"error": "Invalid payload"}), 400
+    except stripe.SignatureVerificationError:
+        logging.warning("Stripe webhook signature verification failed")
+        metrics.inc("stripe_webhooks_total", outcome="invalid")
+        return jsonify({"error": "Invalid signature"}), 400
+    
+    # checkout.session.completed also fires for delayed payment methods that haven't settled yet
+    checkout = event.data.object
+    if event.type not in PAID_CHECKOUT_EVENTS or getattr(checkout, "payment_status", None) != "paid":
+        metrics.inc("stripe_webhooks_total", outcome="ignored")
+        return jsonify({"received": True})
+    
+    reference = getattr(checkout, "client_reference_id", None)
+    recorded = payment_store.record_payment(
+        checkout.id,
+        event.id,
+        client_reference_id=reference,
+        amount_total=getattr(checkout, "amount_total", None),
+        currency=getattr(checkout, "currency", None),
+    )
+    if reference:
+        checkout_cache.invalidate(reference)
+    metrics.inc("stripe_webhooks_total", outcome="recorded" if recorded else "duplicate")
+    return jsonify({"received": True})
+
+_payment_streams = threading.BoundedSemaphore(app.config["PAYMENT_EVENTS_MAX_STREAMS"])
+
+@app.route('/payment-events')
+def payment_events():
+    """Server-Sent Events stream that sends one "paid" event once the current checkout is paid.
+    
+    Replaces polling /payment-status: the browser keeps an EventSource open
+    and reconnects after each PAYMENT_EVENTS_TIMEOUT_SECONDS window. When
+    PAYMENT_EVENTS_MAX_STREAMS streams are already open in this worker, the
+    payment is checked once and the browser is told to reconnect later.
+    """
+    checkout_session_id = session.get('checkout_session_id')
+    already_paid = session.get('paid', False)
+    if checkout_session_id is None and not already_paid:
+        # 204 tells EventSource to stop reconnecting
+        return Response(status=204)
+    timeout = app.config["PAYMENT_EVENTS_TIMEOUT_SECONDS"]
+    
+    busy_retry = app.config["PAYMENT_EVENTS_BUSY_RETRY_MS"]
+    paid_event = f"event: paid\ndata: {json.dumps({'checkout_id': checkout_session_id})}\n\n"
+    
+    def events():
+        # Acquired inside the generator so a stream that never starts never holds a slot
+        if not already_paid and not _payment_streams.acquire(blocking=False):
+            yield f"retry: {busy_retry}\n\n"
+            if payment_store.is_paid(checkout_session_id):
+                yield paid_event
+            return
+        try:
+            yield "retry: 1000\n\n"
+            deadline = time.monotonic() + timeout
+            paid = already_paid
+            while not paid:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                # Comment lines keep proxies from closing an idle connection
+                paid = payment_store.wait_for_payment(checkout_session_id, min(remaining, 10))
+                if not paid:
+                    yield ": keepalive\n\n"
+            yield paid_event
+        finally:
+            if not already_paid:
+                _payment_streams.release()
+    
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({"error": "Upload is too large"}), 413
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics aggregated across all worker processes"""
+    # Optionally require a bearer token so the endpoint isn't public
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get('Authorization', '') != f"Bearer {token}":
+        return jsonify({"error": "Authentication required"}), 403
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def assign_request_id():
+    # Reuse the proxy's request id when there is one so log lines can be correlated
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or secrets.token_hex(8)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profiler = metrics.start_profile()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        endpoint = request.url_rule.endpoint if request.url_rule else "unmatched"
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def stop_request_profile(exc):
+    metrics.stop_profile(g.pop('profiler', None), request.endpoint or "unmatched")
+
 # Add security headers to all responses
 @app.after_request
 def add_security_headers(response):
+    # Echo the request id so a client can quote it when reporting a problem
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    
     # Prevent browsers from detecting the type of a response if the Content-Type header is not set
     response.headers['X-Content-Type-Options'] = 'nosniff'
     
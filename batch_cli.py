@@ -0,0 +1,308 @@
+"""Process a folder or tarball of photos offline with the same pipeline as /upload.
+
+    python batch_cli.py photos/ processed/ --report processed/report.csv
+    python batch_cli.py studio.tar.gz processed/ --previews --workers 4
+
+Every JPG/PNG in the input (searched recursively) becomes a BLS-sized JPEG
+at the same relative path under the output directory. Outputs are written
+atomically, so a run that was interrupted can simply be started again:
+photos whose output already exists are skipped. The report (CSV or JSON,
+by file extension) lists sizes, the JPEG quality chosen and the compliance
+result of every photo; skipped photos keep the details from the report of
+the run that processed them.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import signal
+import logging
+import tarfile
+import argparse
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from image_processing import BLS_MAX_BYTES, allowed_image_filename, inspect_image, process_photo
+
+REPORT_FIELDS = (
+    "source", "status", "output", "input_bytes", "width", "height",
+    "output_bytes", "quality", "encodes", "within_budget", "compliance_passed", "seconds", "error",
+)
+
+# Types of the report fields that CSV stores as text
+INT_FIELDS = {"input_bytes", "width", "height", "output_bytes", "quality", "encodes"}
+BOOL_FIELDS = {"within_budget", "compliance_passed"}
+
+
+def _safe_relpath(name):
+    """Normalize an archive member name; None if it would escape the output directory"""
+    path = os.path.normpath(name.lstrip("/"))
+    if path.startswith("..") or os.path.isabs(path):
+        return None
+    return path
+
+
+@contextmanager
+def open_sources(input_path):
+    """List (relative path, read function) for every accepted image in a directory or tarball.
+
+    A tarball stays open until the block exits so its members can be read.
+    """
+    if os.path.isdir(input_path):
+        sources = []
+        for root, dirs, files in os.walk(input_path):
+            dirs.sort()
+            for filename in sorted(files):
+                if allowed_image_filename(filename):
+                    path = os.path.join(root, filename)
+                    sources.append((os.path.relpath(path, input_path), lambda path=path: _read_file(path)))
+        yield sources
+    elif tarfile.is_tarfile(input_path):
+        with tarfile.open(input_path) as archive:
+            sources = []
+            try:
+                for member in archive:
+                    if not member.isfile() or not allowed_image_filename(member.name):
+                        continue
+                    name = _safe_relpath(member.name)
+                    if name is None:
+                        logging.warning("Skipping archive member outside the archive root: %s", member.name)
+                        continue
+                    sources.append((name, lambda member=member: archive.extractfile(member).read()))
+            except tarfile.TarError as e:
+                # A truncated or corrupt archive still yields the members before the damage
+                logging.warning("%s is damaged after %s photo(s); processing those: %s", input_path, len(sources), e)
+            yield sources
+    else:
+        raise ValueError(f"{input_path} is neither a directory nor a tar archive")
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def output_paths(output_dir, source, previews=False):
+    """Paths of the processed photo (and its preview) for a source image"""
+    stem = os.path.splitext(source)[0]
+    # photo.jpg and photo.png in the same folder must not share an output
+    if not source.lower().endswith((".jpg", ".jpeg")):
+        stem = source
+    image_path = os.path.join(output_dir, f"{stem}.jpg")
+    preview_path = os.path.join(output_dir, f"{stem}_preview.jpg") if previews else None
+    return image_path, preview_path
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _ignore_interrupts():
+    # Ctrl-C is handled by the parent, which cancels the queue and waits for running photos
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def process_file(source, data, image_path, preview_path, max_bytes):
+    """Entry point executed in a pool process; returns the photo's report row"""
+    started = time.perf_counter()
+    row = {"source": source, "output": image_path, "input_bytes": len(data)}
+    try:
+        image = inspect_image(data)
+        row["width"], row["height"] = image.size
+        result = process_photo(data, max_bytes=max_bytes)
+        # The preview first: the photo's presence is what marks the source as done
+        if preview_path:
+            _write_atomic(preview_path, result["preview"])
+        _write_atomic(image_path, result["image"])
+    except Exception as e:
+        row.update(status="failed", error=str(e), seconds=round(time.perf_counter() - started, 3))
+        return row
+
+    row.update(
+        status="done",
+        output_bytes=len(result["image"]),
+        quality=result["quality"],
+        encodes=result["encodes"],
+        within_budget=len(result["image"]) <= max_bytes,
+        compliance_passed=result["compliance"]["passed"],
+        seconds=round(time.perf_counter() - started, 3),
+    )
+    return row
+
+
+def _skipped_row(source, image_path, previous=None):
+    # Keep what the earlier run reported about this photo (quality, compliance, ...)
+    row = dict(previous or {}, source=source, status="skipped", output=image_path)
+    row["output_bytes"] = os.path.getsize(image_path)
+    return row
+
+
+def _progress(done, total, row):
+    if row["status"] == "done":
+        detail = f"{row['output_bytes'] / 1024:.1f} KB at quality {row['quality']}"
+    elif row["status"] == "failed":
+        detail = row["error"]
+    else:
+        detail = "output exists"
+    print(f"[{done}/{total}] {row['source']}: {row['status']} ({detail})", file=sys.stderr, flush=True)
+
+
+def run_batch(sources, output_dir, workers, max_bytes, previews=False, previous=None):
+    """Process (relative path, read function) sources and return the report rows in input order.
+
+    previous maps source paths to rows of an earlier run's report; photos
+    skipped because their output exists keep those details.
+
+    At most two photos per worker are read ahead, so large folders are not
+    loaded into memory at once; a source that cannot be read gets a failed
+    row like a photo that cannot be decoded. On KeyboardInterrupt, queued photos are
+    cancelled and the rows finished so far are returned.
+    """
+    rows = {}
+    pending = {}
+
+    def finish(futures):
+        for future in futures:
+            index = pending.pop(future)
+            if future.exception() is not None:
+                # The pool process died before it could report the failure itself
+                rows[index] = {"source": sources[index][0], "status": "failed", "error": str(future.exception())}
+            else:
+                rows[index] = future.result()
+            _progress(len(rows), len(sources), rows[index])
+
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_ignore_interrupts)
+    try:
+        for index, (source, read) in enumerate(sources):
+            image_path, preview_path = output_paths(output_dir, source, previews)
+            if os.path.exists(image_path):
+                rows[index] = _skipped_row(source, image_path, (previous or {}).get(source))
+                _progress(len(rows), len(sources), rows[index])
+                continue
+            while len(pending) >= workers * 2:
+                finish(wait(pending, return_when=FIRST_COMPLETED).done)
+            try:
+                data = read()
+            except (OSError, tarfile.TarError) as e:
+                # One unreadable file or corrupt member must not end the run
+                rows[index] = {"source": source, "status": "failed", "output": image_path, "error": str(e)}
+                _progress(len(rows), len(sources), rows[index])
+                continue
+            pending[executor.submit(process_file, source, data, image_path, preview_path, max_bytes)] = index
+        while pending:
+            finish(wait(pending, return_when=FIRST_COMPLETED).done)
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume", file=sys.stderr)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    # Photos that were already running when interrupted still finished
+    finish([future for future in pending if not future.cancelled()])
+    return [rows[index] for index in sorted(rows)]
+
+
+def summarize(rows):
+    """Counts and byte totals of a report"""
+    summary = {status: sum(1 for row in rows if row["status"] == status) for status in ("done", "skipped", "failed")}
+    summary["output_bytes"] = sum(row.get("output_bytes") or 0 for row in rows)
+    summary["over_budget"] = sum(1 for row in rows if row.get("within_budget") is False)
+    summary["compliance_failed"] = sum(1 for row in rows if row.get("compliance_passed") is False)
+    return summary
+
+
+def _parse_csv_row(row):
+    parsed = {}
+    for field, value in row.items():
+        if value in ("", None) or field not in REPORT_FIELDS:
+            continue
+        if field in INT_FIELDS:
+            value = int(value)
+        elif field in BOOL_FIELDS:
+            value = value == "True"
+        elif field == "seconds":
+            value = float(value)
+        parsed[field] = value
+    return parsed
+
+
+def read_report(path):
+    """Rows of an existing report keyed by source, or {} when there is none"""
+    try:
+        if path.lower().endswith(".json"):
+            with open(path) as f:
+                rows = json.load(f)["photos"]
+        else:
+            with open(path, newline="") as f:
+                rows = [_parse_csv_row(row) for row in csv.DictReader(f)]
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.exists(path):
+            logging.warning("Could not read the previous report %s: %s", path, e)
+        return {}
+    return {row["source"]: row for row in rows if "source" in row}
+
+
+def write_report(rows, path):
+    """Write the report as JSON (.json) or CSV (anything else)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if path.lower().endswith(".json"):
+        with open(path, "w") as f:
+            json.dump({"summary": summarize(rows), "photos": rows}, f, indent=2)
+    else:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process a folder or tarball of photos like /upload does")
+    parser.add_argument("input", help="directory or tar archive (.tar, .tar.gz, ...) of JPG/PNG photos")
+    parser.add_argument("output", help="directory for the processed photos")
+    parser.add_argument("--report", help="CSV or JSON report path (default: <output>/report.csv)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes to use (default: one per CPU)")
+    parser.add_argument("--max-kb", type=int, default=int(os.environ.get("PHOTO_MAX_KB", BLS_MAX_BYTES // 1024)),
+                        help="maximum size of each processed photo in KB")
+    parser.add_argument("--previews", action="store_true", help="also write a <name>_preview.jpg thumbnail")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(), format="%(levelname)s %(message)s")
+
+    # Pool processes record pipeline metrics; keep them out of the app's METRICS_DIR
+    # (and /metrics) by giving the spawned processes a throwaway directory
+    metrics_dir = tempfile.mkdtemp(prefix="batch-metrics-")
+    os.environ["METRICS_DIR"] = metrics_dir
+    # On a resumed run, photos finished earlier keep their details from the last report
+    # (the default one too, in case this run writes its report somewhere else)
+    default_report_path = os.path.join(args.output, "report.csv")
+    report_path = args.report or default_report_path
+    previous = read_report(default_report_path)
+    if report_path != default_report_path:
+        previous.update(read_report(report_path))
+    try:
+        with open_sources(args.input) as sources:
+            rows = run_batch(sources, args.output, max(1, args.workers), args.max_kb * 1024, args.previews, previous)
+            interrupted = len(rows) < len(sources)
+    except (OSError, ValueError, tarfile.TarError) as e:
+        parser.exit(2, f"{parser.prog}: error: {e}\n")
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    write_report(rows, report_path)
+    summary = summarize(rows)
+    print(f"{summary['done']} processed, {summary['skipped']} skipped, {summary['failed']} failed; "
+          f"report written to {report_path}", file=sys.stderr)
+    if interrupted:
+        return 130
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""Micro-benchmarks for each stage of the upload pipeline.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_stages --repeat 5 --output bench.json
+
+Every corpus input is measured in a fresh process so its peak RSS is not
+inflated by earlier, larger inputs.
+"""
+import io
+import time
+import pickle
+import secrets
+import argparse
+import platform
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import PIL
+from PIL import Image
+
+from compliance import check_photo
+from benchmarks.common import CORPUS, build_corpus, git_revision, peak_rss_kb, summarize, write_report
+from image_processing import (
+    BLS_MAX_BYTES, PHOTO_SIZE, PREVIEW_SIZE, encode_jpeg, encode_jpeg_to_budget, inspect_image,
+    load_image, photo_outputs, process_photo, render_outputs,
+)
+
+
+def _timed(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples), result
+
+
+def bench_input(name, repeat, max_bytes=BLS_MAX_BYTES):
+    """Benchmark every stage for one corpus entry (runs in its own process)"""
+    data = build_corpus([name])[name]
+    stages = {}
+
+    stages["inspect_header"], _ = _timed(lambda: inspect_image(data), repeat)
+    stages["decode_full"], _ = _timed(lambda: Image.open(io.BytesIO(data)).load(), repeat)
+    stages["decode_reduced"], image = _timed(lambda: load_image(data, PHOTO_SIZE), repeat)
+    stages["compliance"], _ = _timed(lambda: check_photo(image), repeat)
+    stages["resize"], resized = _timed(lambda: image.resize(PHOTO_SIZE, Image.LANCZOS), repeat)
+    stages["compress"], encoded = _timed(lambda: encode_jpeg_to_budget(resized, max_bytes=max_bytes), repeat)
+    stages["preview"], _ = _timed(lambda: encode_jpeg(resized.resize(PREVIEW_SIZE, Image.LANCZOS), 75), repeat)
+    stages["render_outputs"], _ = _timed(lambda: render_outputs(image, photo_outputs(max_bytes)), repeat)
+    stages["process_photo"], result = _timed(lambda: process_photo(data, max_bytes=max_bytes), repeat)
+
+    # The session only carries small references since images moved to the blob store
+    session_state = {
+        "csrf_token": secrets.token_hex(16),
+        "paid": False,
+        "download_count": 0,
+        "upload_job_id": secrets.token_hex(16),
+        "processed_image_id": secrets.token_hex(32),
+        "preview_id": secrets.token_hex(32),
+    }
+    stages["session_serialize"], blob = _timed(lambda: pickle.dumps(session_state), repeat)
+    stages["session_deserialize"], _ = _timed(lambda: pickle.loads(blob), repeat)
+
+    return {
+        "input_bytes": len(data),
+        "input_dimensions": list(Image.open(io.BytesIO(data)).size),
+        "output_bytes": len(result["image"]),
+        "quality": result["quality"],
+        "budget_encodes": encoded["encodes"],
+        "jpeg_encodes_per_request": result["encodes"],
+        "session_bytes": len(blob),
+        "peak_rss_kb": peak_rss_kb(),
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the upload pipeline stage by stage")
+    parser.add_argument("--repeat", type=int, default=5, help="iterations per stage")
+    parser.add_argument("--inputs", nargs="*", choices=[entry[0] for entry in CORPUS],
+                        help="corpus entries to run (default: all)")
+    parser.add_argument("--max-kb", type=int, default=BLS_MAX_BYTES // 1024, help="byte budget in KB")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    names = args.inputs or [entry[0] for entry in CORPUS]
+    results = {}
+    for name in names:
+        # A single-use process per input keeps peak RSS figures independent
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results[name] = pool.submit(bench_input, name, args.repeat, args.max_kb * 1024).result()
+
+    write_report({
+        "benchmark": "stages",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "repeat": args.repeat,
+        "results": results,
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import io
+import json
+import random
+import resource
+import statistics
+import subprocess
+
+from PIL import Image
+
+# Synthetic inputs: (name, width, height, format). 5000px is the upload limit.
+CORPUS = [
+    ("small_jpeg", 400, 400, "JPEG"),
+    ("small_png", 400, 400, "PNG"),
+    ("2000_jpeg", 2000, 2000, "JPEG"),
+    ("2000_png", 2000, 2000, "PNG"),
+    ("5000_jpeg", 5000, 5000, "JPEG"),
+    ("5000_png", 5000, 5000, "PNG"),
+]
+
+
+def make_image(width, height, fmt, seed=0):
+    """Build a deterministic photo-like image (smooth gradients plus texture) and encode it"""
+    rng = random.Random(seed)
+    # Low-resolution noise upscaled gives blotchy, photo-like detail that compresses realistically
+    texture = Image.frombytes("RGB", (max(width // 16, 1), max(height // 16, 1)),
+                              rng.randbytes(max(width // 16, 1) * max(height // 16, 1) * 3))
+    texture = texture.resize((width, height), Image.BICUBIC)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    base = Image.merge("RGB", (gradient, gradient.rotate(90), gradient.rotate(180)))
+    image = Image.blend(base, texture, 0.5)
+
+    buf = io.BytesIO()
+    if fmt == "JPEG":
+        image.save(buf, format="JPEG", quality=92)
+    else:
+        image.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def build_corpus(names=None):
+    """Return {name: encoded bytes} for the selected corpus entries"""
+    return {
+        name: make_image(width, height, fmt, seed=index)
+        for index, (name, width, height, fmt) in enumerate(CORPUS)
+        if names is None or name in names
+    }
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(percentile(50), 3),
+        "p95_ms": round(percentile(95), 3),
+        "p99_ms": round(percentile(99), 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "ops_per_sec": round(len(ordered) / sum(ordered), 2) if sum(ordered) else None,
+    }
+
+
+def peak_rss_kb(children=False):
+    """Peak resident set size of this process (or its waited-for children) in KB"""
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss
+
+
+def git_revision():
+    """Current commit, so results from different commits can be compared"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_report(report, output=None):
+    """Write a JSON report to a file, or stdout when output is None"""
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,217 @@
+"""End-to-end load driver for upload -> process -> download.
+
+In-process, using Flask's test client (no server needed):
+
+    python -m benchmarks.load_test --users 4 --requests 40 --input 2000_jpeg
+
+Against a running server, e.g. a local gunicorn:
+
+    gunicorn --bind 127.0.0.1:5000 main:app &
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --users 8 --requests 80
+
+Each simulated user uploads a photo, polls its job until done, fetches the
+result and downloads the image, while a prober measures /payment-status
+latency alongside. With --checkout each flow also creates a checkout
+session; point the app at benchmarks/stripe_stub.py via STRIPE_API_BASE
+(and STRIPE_SECRET_KEY=sk_test_stub) to exercise that path offline. Uploads get unique trailing bytes so the result cache is
+bypassed unless --allow-cache is given.
+"""
+import io
+import os
+import time
+import secrets
+import argparse
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import CORPUS, build_corpus, git_revision, peak_rss_kb, summarize, write_report
+
+POLL_INTERVAL = 0.02
+
+
+class _TestClientUser:
+    """One browser session driven through Flask's test client"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def upload(self, data):
+        response = self.client.post("/upload", data={"image": (io.BytesIO(data), "photo.jpg")},
+                                    content_type="multipart/form-data")
+        return response.status_code, response.get_json()
+
+    def post_form(self, path, form):
+        response = self.client.post(path, data=form)
+        return response.status_code, response.get_json()
+
+    def get_json(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.get_json()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, len(response.get_data())
+
+
+class _HttpUser:
+    """One browser session against a real server"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.http = requests.Session()
+
+    def upload(self, data):
+        response = self.http.post(f"{self.base_url}/upload", files={"image": ("photo.jpg", data)})
+        return response.status_code, response.json()
+
+    def post_form(self, path, form):
+        response = self.http.post(f"{self.base_url}{path}", data=form)
+        return response.status_code, response.json()
+
+    def get_json(self, path):
+        response = self.http.get(f"{self.base_url}{path}")
+        return response.status_code, response.json()
+
+    def get(self, path):
+        response = self.http.get(f"{self.base_url}{path}", allow_redirects=False)
+        return response.status_code, len(response.content)
+
+
+def run_user_flow(user, data, timings, lock, job_lookup=None, checkout=False):
+    """Upload, wait for processing, fetch the result, optionally check out, and download once"""
+    started = time.perf_counter()
+    status_code, body = user.upload(data)
+    uploaded = time.perf_counter()
+    if status_code != 202:
+        with lock:
+            timings["errors"].append(f"upload returned {status_code}")
+        return
+
+    job_id = body["job_id"]
+    while True:
+        _, status = user.get_json(body["status_url"])
+        if status.get("status") != "pending":
+            break
+        time.sleep(POLL_INTERVAL)
+    processed = time.perf_counter()
+    if status.get("status") != "done":
+        with lock:
+            timings["errors"].append(status.get("error", "processing failed"))
+        return
+
+    user.get_json(body["result_url"])
+    if checkout:
+        checkout_started = time.perf_counter()
+        checkout_status, _ = user.post_form("/create-checkout-session", {"csrf_token": body["csrf_token"]})
+        with lock:
+            timings["checkout"].append(time.perf_counter() - checkout_started)
+            if checkout_status != 200:
+                timings["errors"].append(f"checkout returned {checkout_status}")
+    download_started = time.perf_counter()
+    download_status, _ = user.get("/download")
+    finished = time.perf_counter()
+
+    with lock:
+        timings["upload"].append(uploaded - started)
+        timings["processing"].append(processed - uploaded)
+        timings["download"].append(finished - download_started)
+        timings["end_to_end"].append(finished - started)
+        if download_status != 200:
+            timings["errors"].append(f"download returned {download_status}")
+        if job_lookup is not None:
+            job = job_lookup(job_id) or {}
+            timings["encodes"].append(job.get("encodes", 0))
+
+
+def probe(make_user, samples, stop):
+    """Measure /payment-status latency while the load runs"""
+    user = make_user()
+    while not stop.is_set():
+        started = time.perf_counter()
+        user.get("/payment-status")
+        samples.append(time.perf_counter() - started)
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the upload/compress/download path")
+    parser.add_argument("--url", help="base URL of a running server (default: in-process test client)")
+    parser.add_argument("--users", type=int, default=4, help="concurrent users")
+    parser.add_argument("--requests", type=int, default=20, help="total upload flows")
+    parser.add_argument("--input", default="2000_jpeg", choices=[entry[0] for entry in CORPUS])
+    parser.add_argument("--checkout", action="store_true", help="create a checkout session in every flow")
+    parser.add_argument("--allow-cache", action="store_true", help="upload identical bytes every time")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    data = build_corpus([args.input])[args.input]
+
+    if args.url:
+        make_user = lambda: _HttpUser(args.url)
+        job_lookup = None
+        shutdown_pool = None
+    else:
+        from app import app
+        from jobs import get_job_status, shutdown
+        make_user = lambda: _TestClientUser(app)
+        job_lookup = get_job_status
+        shutdown_pool = shutdown
+
+    timings = {key: [] for key in ("upload", "processing", "checkout", "download", "end_to_end", "encodes", "errors")}
+    lock = threading.Lock()
+    probe_samples = []
+    stop = threading.Event()
+    prober = threading.Thread(target=probe, args=(make_user, probe_samples, stop), daemon=True)
+    prober.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        flows = []
+        for _ in range(args.requests):
+            payload = data if args.allow_cache else data + secrets.token_bytes(16)
+            flows.append(pool.submit(run_user_flow, make_user(), payload, timings, lock, job_lookup, args.checkout))
+        for flow in flows:
+            try:
+                flow.result()
+            except Exception as e:
+                timings["errors"].append(f"{type(e).__name__}: {e}")
+    elapsed = time.perf_counter() - started
+    stop.set()
+    prober.join()
+    if shutdown_pool is not None:
+        # Reap the pool so its peak RSS is reported under children
+        shutdown_pool()
+
+    completed = len(timings["end_to_end"])
+    write_report({
+        "benchmark": "load",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "target": args.url or "test_client",
+        "input": args.input,
+        "users": args.users,
+        "requests": args.requests,
+        "completed": completed,
+        "errors": timings["errors"],
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(completed / elapsed, 3) if elapsed else None,
+        "latency": {
+            "upload": summarize(timings["upload"]),
+            "processing": summarize(timings["processing"]),
+            "checkout": summarize(timings["checkout"]),
+            "download": summarize(timings["download"]),
+            "end_to_end": summarize(timings["end_to_end"]),
+            "payment_status": summarize(probe_samples),
+        },
+        "jpeg_encodes_per_request": (round(sum(timings["encodes"]) / len(timings["encodes"]), 2)
+                                     if timings["encodes"] else None),
+        "peak_rss_kb": peak_rss_kb(),
+        "pool_peak_rss_kb": peak_rss_kb(children=True),
+        "cpu_count": os.cpu_count(),
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Cold-start benchmark: app import time and gunicorn time-to-first-response.
+
+    python -m benchmarks.startup --runs 3 --output startup.json
+
+Import time is measured in fresh interpreters, together with the heaviest
+modules app.py pulls in (from -X importtime). Time-to-first-response starts
+gunicorn with gunicorn.conf.py, once with GUNICORN_PRELOAD=1 and once with
+GUNICORN_PRELOAD=0, and measures how long it takes until /payment-status
+answers and until a first upload has been processed. Everything runs in a
+scratch directory so the app's data directories are created from scratch.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from benchmarks.common import build_corpus, git_revision, summarize, write_report
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READY_TIMEOUT_SECONDS = 60
+
+
+def _env(workdir, **extra):
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, METRICS_DIR=os.path.join(workdir, "metrics"))
+    env.update(extra)
+    return env
+
+
+def measure_import(workdir):
+    """Seconds to import app in a fresh interpreter"""
+    code = "import time; started = time.perf_counter(); import app; print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=_env(workdir),
+                            capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def heaviest_imports(workdir, limit=10):
+    """Modules imported directly by app's import tree, by cumulative import time (ms)"""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=workdir,
+                            env=_env(workdir), capture_output=True, text=True, check=True)
+    modules = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # A top-level entry closes its tree; only keep the one under app (not site's)
+        if not name.startswith("  "):
+            if name.strip() == "app":
+                break
+            modules = []
+        # Two spaces of indent: imported by app itself
+        elif not name.startswith("     "):
+            modules.append((int(cumulative) / 1000, name.strip()))
+    modules.sort(reverse=True)
+    return [{"module": name, "ms": round(ms, 1)} for ms, name in modules[:limit]]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_response(workdir, preload, upload_data):
+    """Start gunicorn and time the first status response and the first processed upload"""
+    import requests
+
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", os.path.join(REPO_DIR, "gunicorn.conf.py"),
+         "--bind", f"127.0.0.1:{port}", "main:app"],
+        cwd=workdir, env=_env(workdir, GUNICORN_PRELOAD="1" if preload else "0"),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    http = requests.Session()
+    try:
+        while True:
+            if time.perf_counter() - started > READY_TIMEOUT_SECONDS:
+                raise RuntimeError("gunicorn did not start in time")
+            try:
+                if http.get(f"{base_url}/payment-status", timeout=1).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.01)
+        first_response = time.perf_counter() - started
+
+        upload_started = time.perf_counter()
+        body = http.post(f"{base_url}/upload", files={"image": ("photo.jpg", upload_data)}).json()
+        while http.get(f"{base_url}{body['status_url']}").json().get("status") == "pending":
+            time.sleep(0.01)
+        first_upload = time.perf_counter() - upload_started
+    finally:
+        # Close keep-alive connections first; gthread workers wait for them on shutdown
+        http.close()
+        server.terminate()
+        try:
+            server.wait(timeout=READY_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+    return first_response, first_upload
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and time-to-first-response")
+    parser.add_argument("--runs", type=int, default=3, help="repetitions of each measurement")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    upload_data = build_corpus(["2000_jpeg"])["2000_jpeg"]
+    with tempfile.TemporaryDirectory() as workdir:
+        import_times = [measure_import(workdir) for _ in range(args.runs)]
+        imports = heaviest_imports(workdir)
+        servers = {}
+        for preload in (True, False):
+            first_responses, first_uploads = [], []
+            for _ in range(args.runs):
+                first_response, first_upload = measure_first_response(workdir, preload, upload_data)
+                first_responses.append(first_response)
+                first_uploads.append(first_upload)
+            servers["preload" if preload else "no_preload"] = {
+                "time_to_first_response": summarize(first_responses),
+                "first_upload_processed": summarize(first_uploads),
+            }
+
+    write_report({
+        "benchmark": "startup",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "import_app": summarize(import_times),
+        "heaviest_imports": imports,
+        "gunicorn": servers,
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""Minimal local stand-in for the Stripe API, for load tests without network access.
+
+    python -m benchmarks.stripe_stub --port 12111 --delay 0.3
+    STRIPE_API_BASE=http://127.0.0.1:12111 STRIPE_SECRET_KEY=sk_test_stub gunicorn -c gunicorn.conf.py main:app
+
+Only the endpoints the app calls are implemented. --delay simulates Stripe
+latency so slow upstream calls can be observed under load, and --fail-rate
+answers that fraction of requests with a 500 to exercise retries and the
+circuit breaker. Like Stripe, a POST repeated with the same Idempotency-Key
+returns the original session with an Idempotent-Replayed header.
+
+Tests drive StripeStubHandler directly: fail_next answers that many POSTs
+with fail_status, and received records the path and Idempotency-Key of
+every POST.
+
+With --webhook-url and --webhook-secret, every checkout session is "paid"
+--pay-after seconds after creation and a signed checkout.session.completed
+event is posted to the app:
+
+    python -m benchmarks.stripe_stub --webhook-url http://127.0.0.1:5000/stripe-webhook \
+        --webhook-secret whsec_test --pay-after 2
+    STRIPE_WEBHOOK_SECRET=whsec_test STRIPE_API_BASE=http://127.0.0.1:12111 ... gunicorn -c gunicorn.conf.py main:app
+"""
+import hmac
+import json
+import time
+import random
+import hashlib
+import secrets
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Stripe-Signature header value for payload, as Stripe computes it"""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def send_webhook(url, secret, event_type, data_object):
+    """POST a signed Stripe event to url and return the response status"""
+    payload = json.dumps({
+        "id": f"evt_test_{secrets.token_hex(12)}",
+        "object": "event",
+        "type": event_type,
+        "created": int(time.time()),
+        "livemode": False,
+        "data": {"object": data_object},
+    }).encode()
+    request = urllib.request.Request(url, data=payload, method="POST", headers={
+        "Content-Type": "application/json",
+        "Stripe-Signature": sign_payload(payload, secret),
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def pay_checkout_session(checkout_session, webhook_url, webhook_secret):
+    """Mark a stub checkout session paid and deliver checkout.session.completed"""
+    checkout_session.update({"payment_status": "paid", "status": "complete"})
+    status = send_webhook(webhook_url, webhook_secret, "checkout.session.completed", checkout_session)
+    print(f"Delivered checkout.session.completed for {checkout_session['id']}: HTTP {status}")
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+    fail_rate = 0.0
+    fail_next = 0
+    fail_status = 500
+    received = []
+    webhook_url = None
+    webhook_secret = None
+    pay_after = 2.0
+    sessions = {}
+    idempotent_responses = {}
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_error(self, status):
+        error_type = "api_error" if status >= 500 else "invalid_request_error"
+        self._send_json(status, {"error": {"type": error_type, "message": "Injected stub failure"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        time.sleep(self.delay)
+        if self.path != "/v1/checkout/sessions":
+            self._send_json(404, {"error": {"message": f"Unrecognized request URL (POST: {self.path})"}})
+            return
+        idempotency_key = self.headers.get("Idempotency-Key")
+        StripeStubHandler.received.append((self.path, idempotency_key))
+        if StripeStubHandler.fail_next > 0:
+            StripeStubHandler.fail_next -= 1
+            self._send_error(self.fail_status)
+            return
+        if random.random() < self.fail_rate:
+            self._send_error(500)
+            return
+        if idempotency_key in self.idempotent_responses:
+            self._send_json(200, self.idempotent_responses[idempotency_key], {"Idempotent-Replayed": "true"})
+            return
+        session_id = f"cs_test_{secrets.token_hex(12)}"
+        checkout_session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+            "client_reference_id": form.get("client_reference_id", [None])[0],
+            "mode": form.get("mode", ["payment"])[0],
+            "payment_status": "unpaid",
+            "status": "open",
+            "amount_total": 299,
+            "currency": "cad",
+            "expires_at": int(time.time()) + 24 * 3600,
+        }
+        self.sessions[session_id] = checkout_session
+        if idempotency_key:
+            self.idempotent_responses[idempotency_key] = checkout_session
+        self._send_json(200, checkout_session)
+        if self.webhook_url:
+            threading.Timer(self.pay_after, pay_checkout_session,
+                            (checkout_session, self.webhook_url, self.webhook_secret)).start()
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        prefix = "/v1/checkout/sessions/"
+        checkout_session = self.sessions.get(self.path[len(prefix):]) if self.path.startswith(prefix) else None
+        if checkout_session is None:
+            self._send_json(404, {"error": {"message": "No such checkout.session"}})
+            return
+        self._send_json(200, checkout_session)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Stripe API for local load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before every response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of POSTs answered with a 500")
+    parser.add_argument("--webhook-url", help="app endpoint that receives signed checkout.session.completed events")
+    parser.add_argument("--webhook-secret", default="whsec_test", help="webhook signing secret shared with the app")
+    parser.add_argument("--pay-after", type=float, default=2.0, help="seconds between creating and paying a session")
+    args = parser.parse_args()
+
+    StripeStubHandler.delay = args.delay
+    StripeStubHandler.fail_rate = args.fail_rate
+    StripeStubHandler.webhook_url = args.webhook_url
+    StripeStubHandler.webhook_secret = args.webhook_secret
+    StripeStubHandler.pay_after = args.pay_after
+    server = ThreadingHTTPServer((args.host, args.port), StripeStubHandler)
+    print(f"Stripe stub listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
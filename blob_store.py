@@ -0,0 +1,102 @@
+import os
+import time
+import hashlib
+import logging
+import secrets
+import threading
+
+# Processed images live here; sessions only carry the blob id
+BLOB_DIR = os.environ.get("BLOB_STORE_DIR", "blob_store")
+
+# Blobs not read or written for this many seconds are removed
+BLOB_TTL_SECONDS = int(os.environ.get("BLOB_STORE_TTL", 24 * 3600))
+
+# How often a process sweeps the store for expired blobs
+CLEANUP_INTERVAL_SECONDS = 600
+
+_last_cleanup = 0
+_cleanup_lock = threading.Lock()
+
+
+def _is_valid_id(blob_id):
+    return isinstance(blob_id, str) and len(blob_id) == 64 and all(c in "0123456789abcdef" for c in blob_id)
+
+
+def blob_path(blob_id):
+    """Return the file path of a stored blob, or None if it does not exist"""
+    if not _is_valid_id(blob_id):
+        return None
+    # Absolute, so send_file does not resolve it against the app root
+    path = os.path.abspath(os.path.join(BLOB_DIR, blob_id[:2], blob_id))
+    return path if os.path.isfile(path) else None
+
+
+def put(data):
+    """Store bytes under their sha256 and return the blob id"""
+    blob_id = hashlib.sha256(data).hexdigest()
+    path = os.path.join(BLOB_DIR, blob_id[:2], blob_id)
+    if os.path.isfile(path):
+        # Same content already stored; refresh its TTL
+        touch(blob_id)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{secrets.token_hex(4)}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    maybe_cleanup()
+    return blob_id
+
+
+def read(blob_id):
+    """Return a blob's bytes, or None if it does not exist"""
+    path = blob_path(blob_id)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def touch(blob_id):
+    """Mark a blob as recently used so it survives the next cleanup"""
+    path = blob_path(blob_id)
+    if path is not None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+def cleanup_expired_blobs(max_age=BLOB_TTL_SECONDS):
+    """Remove blobs that have not been used for max_age seconds"""
+    if not os.path.isdir(BLOB_DIR):
+        return 0
+    cutoff = time.time() - max_age
+    removed = 0
+    for root, _, files in os.walk(BLOB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    if removed:
+        logging.info("Removed %s expired blob(s)", removed)
+    return removed
+
+
+def maybe_cleanup():
+    """Run cleanup_expired_blobs at most once per CLEANUP_INTERVAL_SECONDS"""
+    global _last_cleanup
+    now = time.time()
+    with _cleanup_lock:
+        if now - _last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return
+        _last_cleanup = now
+    cleanup_expired_blobs()
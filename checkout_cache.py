@@ -0,0 +1,114 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Open Stripe checkout sessions, keyed on our session's checkout reference and the product.
+# SQLite so every gunicorn worker sees sessions created by the others.
+CHECKOUT_CACHE_PATH = os.environ.get("CHECKOUT_CACHE_PATH", os.path.join("sessions", "checkouts.db"))
+
+# Don't hand out a checkout URL that expires sooner than this
+REUSE_MARGIN_SECONDS = int(os.environ.get("CHECKOUT_REUSE_MARGIN", 600))
+
+# Stripe checkout sessions expire after 24 hours unless created with expires_at
+DEFAULT_LIFETIME_SECONDS = 24 * 3600
+
+_local = threading.local()
+_warming = {}
+_warming_lock = threading.Lock()
+_warm_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="checkout-warm")
+
+
+def _connection():
+    # One connection per thread; sqlite3 connections must not be shared across threads
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        directory = os.path.dirname(CHECKOUT_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = _local.conn = sqlite3.connect(CHECKOUT_CACHE_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkouts ("
+            "reference TEXT NOT NULL, product TEXT NOT NULL, session_id TEXT NOT NULL, "
+            "url TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (reference, product))"
+        )
+        conn.commit()
+    return conn
+
+
+def get(reference, product):
+    """Return the cached checkout {"id", "url", "expires_at"} for reference and product, or None"""
+    row = _connection().execute(
+        "SELECT session_id, url, expires_at FROM checkouts WHERE reference = ? AND product = ?",
+        (reference, product),
+    ).fetchone()
+    if row is None:
+        return None
+    return {"id": row[0], "url": row[1], "expires_at": row[2]}
+
+
+def is_reusable(entry):
+    """Whether a cached checkout stays open long enough to send the user to it"""
+    return entry["expires_at"] - time.time() > REUSE_MARGIN_SECONDS
+
+
+def put(reference, product, checkout_session):
+    """Cache a newly created Stripe checkout session and return its entry"""
+    entry = {
+        "id": checkout_session.id,
+        "url": checkout_session.url,
+        "expires_at": getattr(checkout_session, "expires_at", None) or time.time() + DEFAULT_LIFETIME_SECONDS,
+    }
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO checkouts (reference, product, session_id, url, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (reference, product, entry["id"], entry["url"], entry["expires_at"]),
+        )
+        # Piggyback cleanup of checkouts that can no longer be used
+        conn.execute("DELETE FROM checkouts WHERE expires_at <= ?", (time.time(),))
+    return entry
+
+
+def invalidate(reference):
+    """Forget every cached checkout for reference (after payment or expiry)"""
+    conn = _connection()
+    with conn:
+        conn.execute("DELETE FROM checkouts WHERE reference = ?", (reference,))
+
+
+def warm(reference, product, create):
+    """Run create(reference) in the background unless a usable checkout exists or one is being created"""
+    key = (reference, product)
+    with _warming_lock:
+        if key in _warming:
+            return
+        entry = get(reference, product)
+        if entry is not None and is_reusable(entry):
+            return
+        future = _warming[key] = _warm_executor.submit(create, reference)
+
+    def finished(done):
+        with _warming_lock:
+            _warming.pop(key, None)
+        if done.exception() is not None:
+            logging.warning("Background checkout creation failed: %s", done.exception())
+
+    future.add_done_callback(finished)
+
+
+def wait_for_warm(reference, product, timeout):
+    """Wait for an in-flight background creation for reference and product, if any"""
+    with _warming_lock:
+        future = _warming.get((reference, product))
+    if future is None:
+        return
+    try:
+        future.result(timeout=timeout)
+    except Exception:
+        # The caller falls back to creating the checkout itself
+        pass
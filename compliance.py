@@ -0,0 +1,117 @@
+import time
+import logging
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+# Checks run on a grayscale proxy of the photo this size: big enough for the
+# blur measure, small enough that every check takes well under a millisecond
+PROXY_SIZE = (192, 192)
+
+# A check slower than this is flagged in the report and logged
+CHECK_BUDGET_MS = 5.0
+
+# Background: the top band and the upper side bands should be light and even
+BACKGROUND_BAND_FRACTION = 0.08
+BACKGROUND_MIN_BRIGHTNESS = 180
+BACKGROUND_MAX_STDDEV = 18
+
+# Exposure of the central (face) region, on a 0-255 scale
+EXPOSURE_MIN_BRIGHTNESS = 70
+EXPOSURE_MAX_BRIGHTNESS = 210
+EXPOSURE_MAX_CLIPPED_FRACTION = 0.05
+
+# Variance of the Laplacian of the central region; lower means blurrier
+SHARPNESS_MIN_VARIANCE = 60.0
+
+
+def _center(luma):
+    height, width = luma.shape
+    return luma[height // 4:3 * height // 4, width // 4:3 * width // 4]
+
+
+def check_background(luma):
+    """Brightness and evenness of the border where the background shows"""
+    height, width = luma.shape
+    band_h = max(1, int(height * BACKGROUND_BAND_FRACTION))
+    band_w = max(1, int(width * BACKGROUND_BAND_FRACTION))
+    # The lower part of the frame is shoulders, not background
+    upper = int(height * 0.6)
+    region = np.concatenate((
+        luma[:band_h].ravel(),
+        luma[band_h:upper, :band_w].ravel(),
+        luma[band_h:upper, -band_w:].ravel(),
+    ))
+    brightness = float(region.mean())
+    stddev = float(region.std())
+    return {
+        "passed": brightness >= BACKGROUND_MIN_BRIGHTNESS and stddev <= BACKGROUND_MAX_STDDEV,
+        "brightness": round(brightness, 1),
+        "stddev": round(stddev, 1),
+    }
+
+
+def check_exposure(luma):
+    """Mean brightness and clipped shadows/highlights of the central region"""
+    center = _center(luma)
+    brightness = float(center.mean())
+    clipped = float(np.count_nonzero((center <= 5) | (center >= 250))) / center.size
+    return {
+        "passed": (EXPOSURE_MIN_BRIGHTNESS <= brightness <= EXPOSURE_MAX_BRIGHTNESS
+                   and clipped <= EXPOSURE_MAX_CLIPPED_FRACTION),
+        "brightness": round(brightness, 1),
+        "clipped_fraction": round(clipped, 4),
+    }
+
+
+def check_sharpness(luma):
+    """Variance of the 4-neighbour Laplacian of the central region"""
+    center = _center(luma)
+    laplacian = (center[:-2, 1:-1] + center[2:, 1:-1] + center[1:-1, :-2] + center[1:-1, 2:]
+                 - 4 * center[1:-1, 1:-1])
+    variance = float(laplacian.var())
+    return {
+        "passed": variance >= SHARPNESS_MIN_VARIANCE,
+        "laplacian_variance": round(variance, 1),
+    }
+
+
+CHECKS = (
+    ("background", check_background),
+    ("exposure", check_exposure),
+    ("sharpness", check_sharpness),
+)
+
+
+def check_photo(image):
+    """Run the compliance checks on a decoded image and return a JSON-serializable report.
+
+    The report is advisory: {"passed", "checks"}, where checks maps each
+    check name to its measurements, "passed" and "ms".
+    """
+    with metrics.timer("photo_stage_seconds", stage="compliance", output="proxy"):
+        # reducing_gap lets Pillow shrink by an integer factor first, halving the cost
+        proxy = image.resize(PROXY_SIZE, Image.BOX, reducing_gap=1.0)
+        if proxy.mode != "L":
+            proxy = proxy.convert("L")
+        luma = np.asarray(proxy, dtype=np.float32)
+
+    checks = {}
+    for name, check in CHECKS:
+        started = time.perf_counter()
+        result = check(luma)
+        elapsed = time.perf_counter() - started
+        metrics.observe("photo_stage_seconds", elapsed, stage="compliance", output=name)
+        result["passed"] = bool(result["passed"])
+        result["ms"] = round(elapsed * 1000, 3)
+        if result["ms"] > CHECK_BUDGET_MS:
+            result["over_budget"] = True
+            logging.warning("Compliance check %s took %.1f ms (budget %.1f ms)", name, result["ms"], CHECK_BUDGET_MS)
+        checks[name] = result
+
+    return {
+        "passed": all(result["passed"] for result in checks.values()),
+        "checks": checks,
+    }
@@ -0,0 +1,122 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+FEEDBACK_DIR = 'feedback'
+FEEDBACK_DB = os.path.join(FEEDBACK_DIR, 'feedback.db')
+
+# The JSON file used before feedback moved to SQLite
+LEGACY_FEEDBACK_FILE = os.path.join(FEEDBACK_DIR, 'feedback_records.json')
+
+# PRAGMA user_version once the legacy file has been imported
+LEGACY_MIGRATION_VERSION = 1
+
+_initialized = False
+_init_lock = threading.Lock()
+
+
+def _connect():
+    # Short-lived connections are cheap and safe across gunicorn workers and threads
+    conn = sqlite3.connect(FEEDBACK_DB, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_store():
+    """Create the feedback table and migrate the legacy JSON file once"""
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        os.makedirs(FEEDBACK_DIR, exist_ok=True)
+        conn = _connect()
+        try:
+            # WAL lets admin reads run while other workers append
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS feedback ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "timestamp TEXT NOT NULL, "
+                "name TEXT NOT NULL, "
+                "email TEXT NOT NULL, "
+                "feedback TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS feedback_timestamp ON feedback (timestamp)")
+            conn.commit()
+            _migrate_legacy_file(conn)
+        finally:
+            conn.close()
+        _initialized = True
+
+
+def _migrate_legacy_file(conn):
+    """Import feedback_records.json into the database and rename it out of the way"""
+    if not os.path.exists(LEGACY_FEEDBACK_FILE):
+        return
+
+    # Take the write lock first so only one worker performs the migration
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not os.path.exists(LEGACY_FEEDBACK_FILE):
+            conn.rollback()
+            return
+        # user_version marks a committed import, in case the rename below failed
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= LEGACY_MIGRATION_VERSION:
+            records = None
+            conn.rollback()
+        else:
+            with open(LEGACY_FEEDBACK_FILE, 'r') as f:
+                records = json.load(f)
+            conn.executemany(
+                "INSERT INTO feedback (timestamp, name, email, feedback) VALUES (?, ?, ?, ?)",
+                [(r.get('timestamp', ''), r.get('name', ''), r.get('email', 'Not provided'), r.get('feedback', ''))
+                 for r in records],
+            )
+            conn.execute(f"PRAGMA user_version = {LEGACY_MIGRATION_VERSION}")
+            conn.commit()
+    except (OSError, json.JSONDecodeError, sqlite3.Error) as e:
+        conn.rollback()
+        logging.error("Could not migrate legacy feedback file: %s", e)
+        return
+
+    # Only renamed once the import is committed, so a failed import is retried on the next start.
+    # The original is kept as .migrated in case the import needs to be redone
+    try:
+        os.replace(LEGACY_FEEDBACK_FILE, LEGACY_FEEDBACK_FILE + '.migrated')
+    except OSError as e:
+        logging.error("Could not rename migrated feedback file %s: %s", LEGACY_FEEDBACK_FILE, e)
+    if records is not None:
+        logging.info("Migrated %s feedback record(s) from %s", len(records), LEGACY_FEEDBACK_FILE)
+
+
+def add_feedback(record):
+    """Append one feedback record (dict with timestamp, name, email, feedback)"""
+    init_store()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO feedback (timestamp, name, email, feedback) VALUES (?, ?, ?, ?)",
+                (record['timestamp'], record['name'], record['email'], record['feedback']),
+            )
+    finally:
+        conn.close()
+
+
+def get_feedback_page(page=1, per_page=50):
+    """Return (records, total) for one page of feedback, newest first"""
+    init_store()
+    page = max(page, 1)
+    conn = _connect()
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+        rows = conn.execute(
+            "SELECT timestamp, name, email, feedback FROM feedback "
+            "ORDER BY timestamp DESC, id DESC LIMIT ? OFFSET ?",
+            (per_page, (page - 1) * per_page),
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows], total
@@ -0,0 +1,65 @@
+import os
+import shutil
+
+# SERVER_MODE picks the worker model:
+#   gthread (default): a few processes, each serving many requests on threads,
+#                      so slow Stripe calls and status polls don't block a worker
+#   gevent:            cooperative workers for very high connection counts (needs gevent installed)
+#   sync:              gunicorn's one-request-per-process default
+SERVER_MODE = os.environ.get("SERVER_MODE", "gthread")
+
+_cpus = os.cpu_count() or 1
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+if SERVER_MODE == "gthread":
+    worker_class = "gthread"
+    workers = int(os.environ.get("WEB_CONCURRENCY", max(2, _cpus)))
+    threads = int(os.environ.get("GUNICORN_THREADS", 16))
+elif SERVER_MODE == "gevent":
+    worker_class = "gevent"
+    workers = int(os.environ.get("WEB_CONCURRENCY", max(2, _cpus)))
+    worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+elif SERVER_MODE == "sync":
+    worker_class = "sync"
+    workers = int(os.environ.get("WEB_CONCURRENCY", 2 * _cpus + 1))
+else:
+    raise ValueError(f"Unknown SERVER_MODE: {SERVER_MODE}")
+
+# GUNICORN_PRELOAD=1 (default) imports the app once in the master and warms the
+# image codecs there; forked workers share that memory copy-on-write and can
+# serve as soon as they start. Code reloading (--reload) needs it off.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# Every web worker has its own image processing pool. Its size is the
+# worker's share of the CPUs plus PROCESSING_BATCH_EXTRA processes, so a batch
+# handled by one worker can spread beyond its share without every worker
+# growing a pool the size of the machine. Across all pools, at most
+# PROCESSING_SLOTS jobs (one per CPU) decode and encode at once.
+_processing_share = max(1, _cpus // workers)
+_batch_extra = int(os.environ.get("PROCESSING_BATCH_EXTRA", max(1, _cpus // 4)))
+os.environ.setdefault("PROCESSING_WORKERS", str(_processing_share + _batch_extra))
+
+
+def on_starting(server):
+    # Metrics snapshots are per process; drop the ones left by a previous run
+    shutil.rmtree(os.environ.get("METRICS_DIR", "metrics"), ignore_errors=True)
+
+
+def when_ready(server):
+    # Runs in the master after the preloaded app is imported and before any worker forks
+    if preload_app:
+        from image_processing import warm_up
+        warm_up()
+
+
+def post_worker_init(worker):
+    if not preload_app:
+        from image_processing import warm_up
+        warm_up()
+    # Processing pools are per worker and must start after the fork
+    from jobs import warm_pool
+    warm_pool()
@@ -0,0 +1,304 @@
+import io
+import logging
+from PIL import Image
+
+import metrics
+from compliance import check_photo
+
+# BLS Canada's maximum file size for passport/OCI/visa photos
+BLS_MAX_BYTES = 240 * 1024
+
+# Output sizes of the processed photo and its preview
+PHOTO_SIZE = (600, 600)
+PREVIEW_SIZE = (150, 150)
+
+# Bump when the pipeline output changes so cached results are not reused
+PROCESSING_VERSION = 4
+
+# Accepted uploads
+ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+ALLOWED_FORMATS = ("JPEG", "PNG")
+MAX_DIMENSION = 5000
+
+# Keep at least this multiple of the target size before the final resample
+REDUCING_GAP = 2
+
+# Quality range searched by the budget encoder
+MAX_JPEG_QUALITY = 95
+MIN_JPEG_QUALITY = 20
+JPEG_QUALITY_STEP = 5
+
+
+class InvalidImageError(ValueError):
+    """Raised when uploaded bytes are not an acceptable image"""
+
+
+def allowed_image_filename(filename):
+    """Check the file extension against the accepted upload types"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def inspect_image(data):
+    """Validate an upload from its header alone and return the lazily opened image.
+
+    data may be bytes, a path or a seekable binary file (read from the
+    start). Image.open only parses the header, so invalid or oversize files
+    are rejected before any pixel data is decoded.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    elif hasattr(data, "seek"):
+        data.seek(0)
+    try:
+        image = Image.open(data)
+    except Exception as e:
+        raise InvalidImageError("Invalid image file") from e
+
+    validate_image_header(image)
+    return image
+
+
+def validate_image_header(image):
+    """Check an opened (not yet decoded) image's format and dimensions"""
+    if image.format not in ALLOWED_FORMATS:
+        raise InvalidImageError("Invalid image format")
+    if image.width > MAX_DIMENSION or image.height > MAX_DIMENSION:
+        raise InvalidImageError("Image dimensions are too large")
+
+
+def load_image(data, target_size):
+    """Decode an upload at the lowest resolution that still covers target_size.
+
+    JPEGs are decoded with DCT scaling (draft), which skips most of the decode
+    work for large photos. Other formats are decoded in full and then shrunk by
+    an integer factor with reduce() before the final high-quality resample.
+    """
+    image = inspect_image(data)
+    metrics.observe("photo_input_pixels", image.width, axis="width")
+    metrics.observe("photo_input_pixels", image.height, axis="height")
+    if image.format == "JPEG":
+        image.draft("RGB", target_size)
+    if image.mode == "P":
+        image = image.convert("RGBA")
+
+    factor = min(image.width // (target_size[0] * REDUCING_GAP),
+                 image.height // (target_size[1] * REDUCING_GAP))
+    if factor > 1:
+        image = image.reduce(factor)
+
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image
+
+
+def encode_jpeg(image, quality, subsampling="4:2:0", progressive=False, optimize=False):
+    """Encode a PIL image as JPEG and return the raw bytes"""
+    buf = io.BytesIO()
+    image.save(
+        buf,
+        format="JPEG",
+        quality=quality,
+        subsampling=subsampling,
+        progressive=progressive,
+        optimize=optimize,
+    )
+    return buf.getvalue()
+
+
+def encode_jpeg_to_budget(image, max_bytes=BLS_MAX_BYTES, max_quality=MAX_JPEG_QUALITY,
+                          min_quality=MIN_JPEG_QUALITY, quality_step=JPEG_QUALITY_STEP,
+                          subsampling="4:2:0", progressive=False, optimize=False):
+    """Encode an image as JPEG at the highest quality that fits in max_bytes.
+
+    The image is encoded once at max_quality; if that is too large the quality
+    grid between min_quality and max_quality is bisected, so the number of
+    encodes is bounded by 1 + ceil(log2(grid size + 1)). The returned dict holds
+    the exact bytes that were chosen, so callers never need to decode and
+    re-encode. If nothing fits, min_quality is encoded once more with
+    progressive and optimize enabled (2 + ceil(log2(grid size + 1)) encodes in
+    all); only if that fits are higher qualities tried, one encode per grid
+    step. Otherwise the smallest (min_quality) encoding is returned with
+    within_budget set to False.
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    options = {"subsampling": subsampling, "progressive": progressive, "optimize": optimize}
+    encodes = 0
+
+    def attempt(quality):
+        nonlocal encodes
+        encodes += 1
+        return encode_jpeg(image, quality, **options)
+
+    def result(data, quality):
+        return {
+            "data": data,
+            "size": len(data),
+            "quality": quality,
+            "initial_size": initial_size,
+            "within_budget": len(data) <= max_bytes,
+            "encodes": encodes,
+            "options": options,
+        }
+
+    data = attempt(max_quality)
+    initial_size = len(data)
+    if initial_size <= max_bytes:
+        return result(data, max_quality)
+
+    # Candidate qualities below max_quality, lowest first
+    grid = list(range(min_quality, max_quality, quality_step))
+    best = None
+    smallest = (data, max_quality)
+    lo, hi = 0, len(grid) - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        quality = grid[mid]
+        data = attempt(quality)
+        if len(data) <= max_bytes:
+            best = (data, quality)
+            lo = mid + 1
+        else:
+            if mid == 0:
+                smallest = (data, quality)
+            hi = mid - 1
+
+    if best is not None:
+        return result(*best)
+
+    # Every quality down to min_quality is too large. Progressive, optimized
+    # Huffman tables save a few percent more, so try them at min_quality and
+    # step up only while they keep fitting; they are the most expensive encode
+    if not (progressive and optimize) and grid:
+        options = dict(options, progressive=True, optimize=True)
+        for quality in grid:
+            data = attempt(quality)
+            if len(data) > max_bytes:
+                break
+            best = (data, quality)
+        if best is not None:
+            return result(*best)
+        smallest = (data, grid[0])
+
+    logging.debug("No JPEG quality >= %s fits in %s bytes", min_quality, max_bytes)
+    return result(*smallest)
+
+
+def build_compression_info(encoded, max_bytes):
+    """Describe the outcome of a budget encode for the upload response"""
+    max_kb = round(max_bytes / 1024)
+    compression_info = {}
+    if encoded["initial_size"] > max_bytes:
+        compression_info["warning"] = f"Original resized photo is {round(encoded['initial_size'] / 1024, 2)} KB, exceeding BLS Canada's {max_kb} KB max. Attempting compression..."
+        if encoded["within_budget"]:
+            compression_info["success"] = f"Compressed image to {round(encoded['size'] / 1024, 2)} KB using quality={encoded['quality']}."
+        else:
+            compression_info["error"] = f"Unable to compress under {max_kb} KB even at low quality. Consider uploading a simpler image."
+    return compression_info
+
+
+def photo_outputs(max_bytes=BLS_MAX_BYTES, size=PHOTO_SIZE, preview_size=PREVIEW_SIZE):
+    """Output specs for the BLS photo and its preview, as used by render_outputs"""
+    return [
+        {"name": "image", "size": size, "format": "JPEG", "max_bytes": max_bytes},
+        {"name": "preview", "size": preview_size, "format": "JPEG", "quality": 75},
+    ]
+
+
+def render_outputs(image, outputs):
+    """Render every output spec from one decoded source image.
+
+    Each spec is a dict with name, size and format, plus either max_bytes
+    (JPEG only, encoded with encode_jpeg_to_budget) or quality. Outputs are
+    resampled largest first and each one is derived from the smallest
+    already-resized intermediate that still covers it, so the full-size
+    source is resampled once however many outputs are requested. Returns a
+    dict mapping each name to its encoded data and encode details.
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    intermediates = [image]
+    rendered = {}
+    for spec in sorted(outputs, key=lambda o: o["size"][0] * o["size"][1], reverse=True):
+        width, height = spec["size"]
+        source = min(
+            (i for i in intermediates if i.width >= width and i.height >= height),
+            key=lambda i: i.width * i.height,
+            default=image,
+        )
+        with metrics.timer("photo_stage_seconds", stage="resize", output=spec["name"]):
+            resized = source if source.size == (width, height) else source.resize((width, height), Image.LANCZOS)
+        intermediates.append(resized)
+
+        if spec.get("max_bytes") is not None:
+            if spec["format"] != "JPEG":
+                raise ValueError("Byte budgets are only supported for JPEG outputs")
+            with metrics.timer("photo_stage_seconds", stage="compress", output=spec["name"]):
+                encoded = encode_jpeg_to_budget(resized, max_bytes=spec["max_bytes"])
+            logging.debug("JPEG budget encode for %s finished after %s encode(s) at quality=%s", spec['name'], encoded['encodes'], encoded['quality'])
+            metrics.observe("photo_compression_attempts", encoded["encodes"])
+            if encoded["initial_size"] <= spec["max_bytes"]:
+                outcome = "not_needed"
+            else:
+                outcome = "success" if encoded["within_budget"] else "failure"
+            metrics.inc("photo_compression_total", result=outcome)
+        else:
+            quality = spec.get("quality", 75)
+            with metrics.timer("photo_stage_seconds", stage="encode", output=spec["name"]):
+                buf = io.BytesIO()
+                resized.save(buf, format=spec["format"], quality=quality)
+            encoded = {"data": buf.getvalue(), "quality": quality, "encodes": 1}
+        metrics.observe("photo_output_bytes", len(encoded["data"]), output=spec["name"])
+        rendered[spec["name"]] = dict(encoded, format=spec["format"], dimensions=(width, height))
+    return rendered
+
+
+def process_photo(data, max_bytes=BLS_MAX_BYTES, size=PHOTO_SIZE, preview_size=PREVIEW_SIZE):
+    """Turn uploaded image bytes into the BLS photo and its preview.
+
+    Runs without any Flask context so it can be executed in a worker process.
+    data is the upload's bytes or the path of a file holding them. Returns a dict with the encoded photo, the preview, compression info and
+    the compliance report.
+    """
+    outputs = photo_outputs(max_bytes, size, preview_size)
+    with metrics.timer("photo_stage_seconds", stage="decode", output="source"):
+        image = load_image(data, size)
+    compliance = check_photo(image)
+    rendered = render_outputs(image, outputs)
+    encoded = rendered["image"]
+
+    return {
+        "image": encoded["data"],
+        "preview": rendered["preview"]["data"],
+        "quality": encoded["quality"],
+        "encodes": sum(output["encodes"] for output in rendered.values()),
+        "compression_info": build_compression_info(encoded, max_bytes),
+        "compliance": compliance,
+    }
+
+
+def processing_params(max_bytes=BLS_MAX_BYTES, size=PHOTO_SIZE, preview_size=PREVIEW_SIZE):
+    """Parameters that determine process_photo's output, used for cache keys"""
+    return {
+        "version": PROCESSING_VERSION,
+        "max_bytes": max_bytes,
+        "size": list(size),
+        "preview_size": list(preview_size),
+    }
+
+
+def warm_up():
+    """Decode, render and encode a tiny JPEG and PNG once.
+
+    Loads Pillow's format plugins and codecs before the first real upload,
+    e.g. in the gunicorn master before workers fork. What it records is
+    dropped from the metrics.
+    """
+    image = Image.new("RGB", (64, 64), (128, 128, 128))
+    for image_format in ALLOWED_FORMATS:
+        buf = io.BytesIO()
+        image.save(buf, format=image_format)
+        render_outputs(load_image(buf.getvalue(), PREVIEW_SIZE), photo_outputs())
+    metrics.discard()
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+import secrets
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import blob_store
+import metrics
+import result_cache
+from image_processing import process_photo, warm_up
+
+# Results are written to disk so any gunicorn worker can answer status requests
+JOBS_DIR = os.environ.get("PROCESSING_JOBS_DIR", "processing_jobs")
+
+# Size of the worker pool and how many jobs a web worker may have in flight.
+# Processes are started on demand, up to MAX_WORKERS, when no idle one is free
+MAX_WORKERS = int(os.environ.get("PROCESSING_WORKERS", os.cpu_count() or 1))
+
+# Jobs that may run at once on this machine, across the pools of every web
+# worker; a job waits for a free slot before decoding anything. Slots are
+# flock()ed files, so a crashed pool process releases its slot
+PROCESSING_SLOTS = int(os.environ.get("PROCESSING_SLOTS", os.cpu_count() or 1))
+SLOTS_DIR = os.path.join(JOBS_DIR, ".slots")
+SLOT_POLL_SECONDS = 0.05
+MAX_PENDING_JOBS = int(os.environ.get("PROCESSING_MAX_PENDING", max(MAX_WORKERS * 4, 32)))
+
+# Pool processes started (and warmed) ahead of the first upload
+WARM_WORKERS = min(MAX_WORKERS, int(os.environ.get("PROCESSING_WARM_WORKERS", 1)))
+
+# Finished jobs that were never collected are removed after this many seconds
+JOB_TTL_SECONDS = int(os.environ.get("PROCESSING_JOB_TTL", 3600))
+
+# How often a process sweeps JOBS_DIR for expired jobs
+CLEANUP_INTERVAL_SECONDS = 600
+
+# The upload is stored in the job directory under this name until it is processed
+UPLOAD_FILENAME = "upload"
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = {}
+_last_cleanup = 0
+_cleanup_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Raised when the processing queue has no room for another job"""
+
+
+def _get_executor():
+    """Create the process pool on first use (after gunicorn has forked)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logging.info("Started image processing pool with %s worker(s)", MAX_WORKERS)
+        return _executor
+
+
+def warm_pool():
+    """Start WARM_WORKERS pool processes now and warm their codecs, so the first upload doesn't wait for them"""
+    executor = _get_executor()
+    for _ in range(WARM_WORKERS):
+        executor.submit(warm_up)
+
+
+def shutdown(wait=True):
+    """Stop the process pool; it is recreated on the next submitted job"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def _job_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def _write_status(job_dir, status):
+    """Atomically replace a job's status file"""
+    tmp_path = os.path.join(job_dir, "status.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, os.path.join(job_dir, "status.json"))
+
+
+def _store_result(result):
+    """Put a processed result's images in the blob store; returns its metadata with their blob ids"""
+    stored = {k: v for k, v in result.items() if k not in ("image", "preview")}
+    stored["image_id"] = blob_store.put(result["image"])
+    stored["preview_id"] = blob_store.put(result["preview"])
+    return stored
+
+
+def _write_result(job_dir, result, duration, cached=False):
+    """Mark the job done with a result whose images are already in the blob store"""
+    _write_status(job_dir, {
+        "status": "done",
+        "image_id": result["image_id"],
+        "preview_id": result["preview_id"],
+        "quality": result["quality"],
+        "encodes": 0 if cached else result["encodes"],
+        "cached": cached,
+        "compression_info": result["compression_info"],
+        "compliance": result["compliance"],
+        "duration": duration,
+    })
+
+
+def _store_upload(job_dir, upload):
+    """Copy the upload (bytes or a binary file) into the job directory for the pool process to read"""
+    path = os.path.join(job_dir, UPLOAD_FILENAME)
+    with open(path, "wb") as f:
+        if isinstance(upload, (bytes, bytearray)):
+            f.write(upload)
+        else:
+            upload.seek(0)
+            shutil.copyfileobj(upload, f)
+    return path
+
+
+def _acquire_slot():
+    """Block until one of the PROCESSING_SLOTS machine-wide slots is free; closing the returned file releases it"""
+    os.makedirs(SLOTS_DIR, exist_ok=True)
+    while True:
+        for slot in range(PROCESSING_SLOTS):
+            f = open(os.path.join(SLOTS_DIR, f"{slot}.lock"), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                f.close()
+        time.sleep(SLOT_POLL_SECONDS)
+
+
+def _run_photo_job(job_dir, upload_path, max_bytes, cache_key=None):
+    """Entry point executed in a pool process"""
+    with metrics.timer("processing_slot_wait_seconds"):
+        slot = _acquire_slot()
+    started = time.time()
+    profiler = metrics.start_profile()
+    try:
+        result = _store_result(process_photo(upload_path, max_bytes=max_bytes))
+        _write_result(job_dir, result, round(time.time() - started, 3))
+        if cache_key:
+            result_cache.put(cache_key, result, memory=False)
+        metrics.inc("photo_jobs_total", status="done")
+    except Exception as e:
+        logging.error("Error processing image: %s", e)
+        _write_status(job_dir, {"status": "failed", "error": f"Error processing image: {str(e)}"})
+        metrics.inc("photo_jobs_total", status="failed")
+    finally:
+        slot.close()
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
+        metrics.stop_profile(profiler, "photo_job")
+        # Pool processes may sit idle for a while, so publish the job's metrics now
+        metrics.flush()
+
+
+def _job_finished(job_id, future):
+    with _executor_lock:
+        _pending.pop(job_id, None)
+    if future.exception() is not None:
+        # The worker process died before it could record the failure itself
+        logging.error("Processing job %s crashed: %s", job_id, future.exception())
+        try:
+            _write_status(_job_dir(job_id), {"status": "failed", "error": "Error processing image"})
+        except OSError:
+            pass
+
+
+def _new_job_dir():
+    maybe_cleanup()
+    job_id = secrets.token_hex(16)
+    job_dir = _job_dir(job_id)
+    os.makedirs(job_dir)
+    return job_id, job_dir
+
+
+def submit_photo_job(upload, max_bytes, cache_key=None):
+    """Queue an upload (bytes or a seekable binary file) for processing and return the job id.
+
+    The upload is copied into the job directory in chunks and the pool
+    process reads it from there, so large uploads are never held in memory
+    or pickled.
+    """
+    with _executor_lock:
+        if len(_pending) >= MAX_PENDING_JOBS:
+            raise QueueFullError("Too many images are being processed. Please try again shortly.")
+
+    job_id, job_dir = _new_job_dir()
+    _write_status(job_dir, {"status": "pending"})
+
+    upload_path = _store_upload(job_dir, upload)
+    future = _get_executor().submit(_run_photo_job, job_dir, upload_path, max_bytes, cache_key)
+    with _executor_lock:
+        _pending[job_id] = future
+    future.add_done_callback(lambda f: _job_finished(job_id, f))
+    return job_id
+
+
+def has_capacity(count):
+    """Whether this worker can queue count more jobs without hitting the limit"""
+    with _executor_lock:
+        return len(_pending) + count <= MAX_PENDING_JOBS
+
+
+def iter_finished_jobs(job_ids, timeout=None):
+    """Yield job ids as their jobs finish, in completion order.
+
+    Jobs that are not running in this worker (already finished, or cache
+    hits) are yielded first. Raises TimeoutError like as_completed.
+    """
+    with _executor_lock:
+        futures = {_pending[job_id]: job_id for job_id in job_ids if job_id in _pending}
+    running = set(futures.values())
+    for job_id in job_ids:
+        if job_id not in running:
+            yield job_id
+    for future in as_completed(futures, timeout=timeout):
+        yield futures[future]
+
+
+def create_finished_job(result):
+    """Record an already available result (e.g. a cache hit, whose images are in the blob store) as a finished job"""
+    job_id, job_dir = _new_job_dir()
+    _write_result(job_dir, result, 0, cached=True)
+    metrics.inc("photo_jobs_total", status="cached")
+    return job_id
+
+
+def get_job_status(job_id):
+    """Return the status dict of a job, or None if the job is unknown"""
+    # Job ids are generated by us; refuse anything that could escape JOBS_DIR
+    if not job_id or not all(c in "0123456789abcdef" for c in job_id):
+        return None
+    try:
+        with open(os.path.join(_job_dir(job_id), "status.json")) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def cleanup_expired_jobs(max_age=JOB_TTL_SECONDS):
+    """Remove job directories older than max_age seconds"""
+    if not os.path.isdir(JOBS_DIR):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(JOBS_DIR):
+        # Skip SLOTS_DIR; job ids are hex
+        if name.startswith("."):
+            continue
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def maybe_cleanup():
+    """Run cleanup_expired_jobs at most once per CLEANUP_INTERVAL_SECONDS"""
+    global _last_cleanup
+    now = time.time()
+    with _cleanup_lock:
+        if now - _last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return
+        _last_cleanup = now
+    cleanup_expired_jobs()
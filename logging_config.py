@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import datetime
+import logging.handlers
+
+# LOG_LEVEL: standard level name. LOG_FORMAT: "text" or "json".
+# LOG_SAMPLE_RATE: fraction of INFO/DEBUG records to keep (warnings and errors are never sampled).
+DEFAULT_LEVEL = "INFO"
+
+_listener = None
+_configured = False
+
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current request id (or '-') to every record"""
+
+    def filter(self, record):
+        request_id = "-"
+        try:
+            from flask import g, has_request_context
+            if has_request_context():
+                request_id = g.get("request_id", "-")
+        except ImportError:
+            pass
+        record.request_id = request_id
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of informational records"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+            "process": record.process,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock handler formats every record in the calling thread; here the
+    record is queued as-is, so args are only interpolated when written.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def _start_listener(handler):
+    global _listener
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    return log_queue
+
+
+def configure_logging():
+    """Configure the root logger from the environment; writes happen on a background thread"""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    level = os.environ.get("LOG_LEVEL", DEFAULT_LEVEL).upper()
+    log_format = os.environ.get("LOG_FORMAT", "text").lower()
+    sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", 1))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:[%(request_id)s] %(message)s"))
+
+    queue_handler = DeferredQueueHandler(_start_listener(stream_handler))
+    queue_handler.addFilter(RequestIdFilter())
+    if sample_rate < 1:
+        queue_handler.addFilter(SamplingFilter(sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    def restart_in_child():
+        # The listener thread does not survive fork (e.g. gunicorn --preload)
+        queue_handler.queue = _start_listener(stream_handler)
+
+    os.register_at_fork(after_in_child=restart_in_child)
+    atexit.register(lambda: _listener.stop())
@@ -0,0 +1,220 @@
+import os
+import time
+import atexit
+import json
+import random
+import logging
+import secrets
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Every process (gunicorn workers and pool workers) writes its own snapshot here;
+# /metrics sums them so the numbers cover all processes
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+
+# Snapshots are written at most this often per process
+FLUSH_INTERVAL_SECONDS = 1.0
+
+# Fraction of requests/jobs to run under cProfile (0 disables profiling)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help, buckets)
+METRICS = {
+    "photo_stage_seconds": ("histogram", "Time spent in each image processing stage", TIME_BUCKETS),
+    "photo_compression_attempts": ("histogram", "JPEG encodes needed to fit the byte budget", (1, 2, 3, 4, 5, 6, 8, 10)),
+    "photo_compression_total": ("counter", "Byte budget encodes by outcome", None),
+    "photo_input_pixels": ("histogram", "Uploaded image dimensions", (300, 600, 1000, 2000, 3000, 4000, 5000)),
+    "photo_output_bytes": ("histogram", "Size of encoded outputs", (10240, 25600, 51200, 102400, 153600, 204800, 245760, 512000)),
+    "photo_jobs_total": ("counter", "Finished processing jobs by status", None),
+    "processing_slot_wait_seconds": ("histogram", "Time a job waited for a machine-wide processing slot", TIME_BUCKETS),
+    "session_save_seconds": ("histogram", "Time spent writing the session", TIME_BUCKETS),
+    "http_request_duration_seconds": ("histogram", "Request latency by endpoint", TIME_BUCKETS),
+    "result_cache_lookups_total": ("counter", "Result cache lookups by outcome", None),
+    "stripe_requests_total": ("counter", "Stripe API calls by outcome", None),
+    "checkout_cache_lookups_total": ("counter", "Checkout session reuse lookups by outcome", None),
+    "stripe_webhooks_total": ("counter", "Stripe webhook deliveries by outcome", None),
+    "stripe_request_seconds": ("histogram", "Stripe API call latency including retries", TIME_BUCKETS),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_process_file = None
+_last_flush = 0
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    """Increment a counter"""
+    with _lock:
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    """Record one observation in a histogram"""
+    buckets = METRICS[name][2]
+    with _lock:
+        key = _key(name, labels)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+                break
+        else:
+            histogram["buckets"][-1] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+    _maybe_flush()
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of a block in a seconds histogram"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            "histograms": [[name, list(labels), data] for (name, labels), data in _histograms.items()],
+        }
+
+
+def flush():
+    """Write this process's metrics snapshot to METRICS_DIR"""
+    global _process_file, _last_flush
+    _last_flush = time.time()
+    try:
+        if _process_file is None:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            _process_file = os.path.join(METRICS_DIR, f"{os.getpid()}-{secrets.token_hex(4)}.json")
+        tmp_path = f"{_process_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(_snapshot(), f)
+        os.replace(tmp_path, _process_file)
+    except OSError as e:
+        logging.debug("Could not write metrics snapshot: %s", e)
+
+
+def _maybe_flush():
+    if time.time() - _last_flush >= FLUSH_INTERVAL_SECONDS:
+        flush()
+
+
+def _reset():
+    global _lock, _process_file, _last_flush
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+    _process_file = None
+    _last_flush = 0
+
+
+def discard():
+    """Drop everything this process has recorded, including its snapshot file (e.g. after a warm-up)"""
+    path = _process_file
+    _reset()
+    if path is not None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# A worker forked from a preloaded master starts with empty metrics and its own snapshot file
+os.register_at_fork(after_in_child=_reset)
+
+
+@atexit.register
+def _flush_at_exit():
+    if _counters or _histograms:
+        flush()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def render():
+    """Aggregate all process snapshots into Prometheus text exposition format"""
+    flush()
+    counters = {}
+    histograms = {}
+    for name in os.listdir(METRICS_DIR) if os.path.isdir(METRICS_DIR) else []:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshot = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        for metric, labels, value in snapshot["counters"]:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, data in snapshot["histograms"]:
+            key = (metric, tuple(tuple(pair) for pair in labels))
+            total = histograms.setdefault(key, {"buckets": [0] * len(data["buckets"]), "sum": 0.0, "count": 0})
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], data["buckets"])]
+            total["sum"] += data["sum"]
+            total["count"] += data["count"]
+
+    lines = []
+    for metric, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        if kind == "counter":
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric:
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+            continue
+        for (name, labels), data in sorted(histograms.items()):
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], data["buckets"]):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {data['sum']}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {data['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def start_profile():
+    """Return an enabled profiler for a sampled fraction of calls, otherwise None"""
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, label):
+    """Stop a profiler from start_profile and dump its stats to PROFILE_DIR"""
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_label = "".join(c if c.isalnum() or c in "-_" else "_" for c in label)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{int(time.time())}-{safe_label}-{secrets.token_hex(3)}.prof"))
+    except OSError as e:
+        logging.debug("Could not write profile: %s", e)
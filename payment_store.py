@@ -0,0 +1,71 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+# Payments confirmed by Stripe webhooks, keyed by checkout session id. Every
+# instance that serves /payment-events must see the same file (point
+# PAYMENT_STORE_PATH at shared storage when running more than one instance).
+PAYMENT_STORE_PATH = os.environ.get("PAYMENT_STORE_PATH", os.path.join("payments", "payments.db"))
+
+_local = threading.local()
+
+
+def _connection():
+    # One connection per thread; sqlite3 connections must not be shared across threads
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        directory = os.path.dirname(PAYMENT_STORE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = _local.conn = sqlite3.connect(PAYMENT_STORE_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            "checkout_session_id TEXT PRIMARY KEY, "
+            "client_reference_id TEXT, "
+            "amount_total INTEGER, "
+            "currency TEXT, "
+            "event_id TEXT NOT NULL, "
+            "paid_at REAL NOT NULL)"
+        )
+        conn.commit()
+    return conn
+
+
+def record_payment(checkout_session_id, event_id, client_reference_id=None, amount_total=None, currency=None):
+    """Record a confirmed payment; returns False if it was already recorded (webhook redelivery)"""
+    conn = _connection()
+    with conn:
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO payments "
+            "(checkout_session_id, client_reference_id, amount_total, currency, event_id, paid_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (checkout_session_id, client_reference_id, amount_total, currency, event_id, time.time()),
+        ).rowcount
+    if inserted:
+        logging.info("Recorded payment for checkout session %s", checkout_session_id)
+    return bool(inserted)
+
+
+def is_paid(checkout_session_id):
+    """Whether Stripe has confirmed payment of this checkout session"""
+    if not checkout_session_id:
+        return False
+    row = _connection().execute(
+        "SELECT 1 FROM payments WHERE checkout_session_id = ?", (checkout_session_id,)
+    ).fetchone()
+    return row is not None
+
+
+def wait_for_payment(checkout_session_id, timeout, interval=0.5):
+    """Block until the checkout session is paid or timeout passes; returns whether it was paid"""
+    deadline = time.monotonic() + timeout
+    while True:
+        if is_paid(checkout_session_id):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
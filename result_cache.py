@@ -0,0 +1,203 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import time
+import secrets
+import threading
+from collections import OrderedDict
+
+import blob_store
+
+# Processed photos are cached on disk so every worker (and the pool) shares them.
+# An entry holds the blob ids of the photo and preview plus their metadata;
+# the images themselves are stored once, in the content-addressed blob store
+CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "result_cache")
+DISK_LIMIT_BYTES = int(os.environ.get("RESULT_CACHE_DISK_MB", 256)) * 1024 * 1024
+MEMORY_LIMIT_BYTES = int(os.environ.get("RESULT_CACHE_MEMORY_MB", 32)) * 1024 * 1024
+HASH_CHUNK_BYTES = 1024 * 1024
+
+# How often a process walks the disk tier to evict entries; between sweeps
+# the cache can overshoot DISK_LIMIT_BYTES by what was stored meanwhile
+EVICT_INTERVAL_SECONDS = 60
+
+_memory = OrderedDict()
+_memory_bytes = 0
+_lock = threading.Lock()
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+_last_eviction = 0
+
+
+def make_key(data, params):
+    """Build a cache key from the upload (bytes or a seekable binary file) and the processing parameters"""
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray)):
+        digest.update(data)
+    else:
+        # Hash spooled uploads in chunks instead of reading them into memory
+        data.seek(0)
+        for chunk in iter(lambda: data.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def _entry_size(result):
+    return len(json.dumps(result))
+
+
+def _blobs_available(result):
+    """Whether the entry's images are still in the blob store; refreshes their TTL when they are"""
+    if blob_store.blob_path(result.get("image_id")) is None or blob_store.blob_path(result.get("preview_id")) is None:
+        return False
+    blob_store.touch(result["image_id"])
+    blob_store.touch(result["preview_id"])
+    return True
+
+
+def _forget(key):
+    """Drop an entry whose images have expired from the blob store"""
+    global _memory_bytes
+    with _lock:
+        result = _memory.pop(key, None)
+        if result is not None:
+            _memory_bytes -= _entry_size(result)
+    shutil.rmtree(_entry_dir(key), ignore_errors=True)
+
+
+def _remember(key, result):
+    """Insert a result into the in-memory tier, evicting least recently used entries"""
+    global _memory_bytes
+    size = _entry_size(result)
+    if size > MEMORY_LIMIT_BYTES:
+        return
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return
+        _memory[key] = result
+        _memory_bytes += size
+        while _memory_bytes > MEMORY_LIMIT_BYTES:
+            _, evicted = _memory.popitem(last=False)
+            _memory_bytes -= _entry_size(evicted)
+
+
+def _miss():
+    with _lock:
+        _stats["misses"] += 1
+    return None
+
+
+def get(key):
+    """Return the cached result for key (metadata with image_id and preview_id), or None on a miss"""
+    with _lock:
+        result = _memory.get(key)
+        if result is not None:
+            _memory.move_to_end(key)
+    if result is not None:
+        if not _blobs_available(result):
+            _forget(key)
+            return _miss()
+        with _lock:
+            _stats["memory_hits"] += 1
+        return result
+
+    entry_dir = _entry_dir(key)
+    try:
+        with open(os.path.join(entry_dir, "meta.json")) as f:
+            result = json.load(f)
+        # Touch the entry so disk eviction is least-recently-used
+        os.utime(entry_dir)
+    except (OSError, json.JSONDecodeError):
+        return _miss()
+    # Entries written before images moved to the blob store have no blob ids
+    if not _blobs_available(result):
+        _forget(key)
+        return _miss()
+
+    _remember(key, result)
+    with _lock:
+        _stats["disk_hits"] += 1
+    return result
+
+
+def put(key, result, memory=True):
+    """Store a processed result whose images are in the blob store (dict with image_id, preview_id and metadata).
+
+    Pool processes pass memory=False; their in-memory tier would never be read.
+    """
+    if memory:
+        _remember(key, result)
+
+    entry_dir = _entry_dir(key)
+    if os.path.isdir(entry_dir):
+        return
+    # Write into a private directory first so readers never see a partial entry
+    tmp_dir = os.path.join(CACHE_DIR, f".tmp-{secrets.token_hex(8)}")
+    try:
+        os.makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(result, f)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        os.rename(tmp_dir, entry_dir)
+    except OSError as e:
+        # Another process stored the same key first, or the disk is unavailable
+        logging.debug("Result cache store skipped: %s", e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+
+    with _lock:
+        _stats["stores"] += 1
+    maybe_evict_disk()
+
+
+def evict_disk(limit=None):
+    """Remove least recently used disk entries until the cache fits in limit bytes"""
+    limit = DISK_LIMIT_BYTES if limit is None else limit
+    entries = []
+    total = 0
+    for root, _, files in os.walk(CACHE_DIR):
+        if "meta.json" not in files:
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            entries.append((os.path.getmtime(root), size, root))
+        except OSError:
+            continue
+        total += size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        with _lock:
+            _stats["evictions"] += 1
+
+
+def maybe_evict_disk():
+    """Run evict_disk at most once per EVICT_INTERVAL_SECONDS"""
+    global _last_eviction
+    now = time.time()
+    with _lock:
+        if now - _last_eviction < EVICT_INTERVAL_SECONDS:
+            return
+        _last_eviction = now
+    evict_disk()
+
+
+def get_stats():
+    """Return hit/miss counters for this process"""
+    with _lock:
+        stats = dict(_stats)
+        stats["memory_entries"] = len(_memory)
+        stats["memory_bytes"] = _memory_bytes
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 3) if lookups else 0.0
+    return stats
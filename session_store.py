@@ -0,0 +1,296 @@
+import os
+import copy
+import time
+import pickle
+import secrets
+import sqlite3
+import logging
+import threading
+
+from flask.sessions import SecureCookieSessionInterface, SessionMixin
+
+# Small, frequently read keys that travel in the signed cookie. Everything else
+# is kept server-side and only loaded when a request actually touches it.
+# Cookies are signed, not encrypted: never put personal data in this list.
+# A client can also replay an older cookie, so download and payment state
+# (download_count, paid, checkout_session_id, ...) stays server-side.
+DEFAULT_COOKIE_KEYS = frozenset({
+    "csrf_token",
+    "upload_job_id",
+    "processed_image_id",
+    "preview_id",
+    "checkout_reference",
+    "batch_id",
+    # Flask's own bookkeeping keys
+    "_permanent",
+    "_flashes",
+})
+
+# Cookie key that links the cookie to its server-side row
+SID_KEY = "_sid"
+
+# Server-side rows unused for this long are removed
+SERVER_SESSION_TTL = int(os.environ.get("SESSION_SERVER_TTL", 7 * 24 * 3600))
+CLEANUP_INTERVAL_SECONDS = 600
+
+
+class SQLiteSessionStore:
+    """Server-side session data in SQLite (point the path at /dev/shm for a shared-memory store)"""
+
+    def __init__(self, path, ttl=SERVER_SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._last_cleanup = 0
+        # Connections opened before a fork (gunicorn --preload) must not be used by the child
+        os.register_at_fork(after_in_child=self._forget_connections)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+        conn.commit()
+
+    def _connection(self):
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _forget_connections(self):
+        self._local = threading.local()
+
+    def load(self, sid):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE sid = ? AND expires > ?", (sid, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else {}
+
+    def save(self, sid, data):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)",
+                (sid, pickle.dumps(data), time.time() + self.ttl),
+            )
+        self._maybe_cleanup()
+
+    def delete(self, sid):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def _maybe_cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return
+        self._last_cleanup = now
+        conn = self._connection()
+        with conn:
+            removed = conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,)).rowcount
+        if removed:
+            logging.info("Removed %s expired server-side session(s)", removed)
+
+
+class HybridSession(dict, SessionMixin):
+    """Session whose cookie keys are available immediately and whose other keys load on first use"""
+
+    def __init__(self, cookie_data, sid, store, cookie_keys):
+        super().__init__(cookie_data)
+        self.sid = sid
+        self.initial_sid = sid
+        self.store = store
+        self.cookie_keys = cookie_keys
+        self.modified = False
+        self.accessed = False
+        # Deep copies: values like _flashes or batch_jobs are mutated in place
+        self.initial_cookie = copy.deepcopy(cookie_data)
+        self.initial_server = None
+
+    @property
+    def server_loaded(self):
+        return self.initial_server is not None
+
+    def _load_server(self):
+        if self.server_loaded:
+            return
+        data = self.store.load(self.sid) if self.sid else {}
+        self.initial_server = copy.deepcopy(data)
+        for key, value in data.items():
+            if key not in self.cookie_keys:
+                dict.setdefault(self, key, value)
+
+    def _touch(self, key=None, write=False):
+        self.accessed = True
+        if write:
+            self.modified = True
+        if key is None or key not in self.cookie_keys:
+            self._load_server()
+
+    def __getitem__(self, key):
+        self._touch(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._touch(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self._touch(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        self._touch(key, write=True)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._touch(key, write=True)
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        self._touch(key, write=True)
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        self._touch(key, write=True)
+        return super().setdefault(key, default)
+
+    def __iter__(self):
+        self._touch()
+        return super().__iter__()
+
+    def __len__(self):
+        self._touch()
+        return super().__len__()
+
+    def keys(self):
+        self._touch()
+        return super().keys()
+
+    def items(self):
+        self._touch()
+        return super().items()
+
+    def values(self):
+        self._touch()
+        return super().values()
+
+    def update(self, *args, **kwargs):
+        self._touch(write=True)
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self._touch(write=True)
+        super().clear()
+
+    def popitem(self):
+        self._touch(write=True)
+        return super().popitem()
+
+    def copy(self):
+        self._touch()
+        return dict(super().items())
+
+    def cookie_part(self):
+        return {k: v for k, v in dict.items(self) if k in self.cookie_keys}
+
+    def server_part(self):
+        return {k: v for k, v in dict.items(self) if k not in self.cookie_keys}
+
+
+class HybridSessionInterface(SecureCookieSessionInterface):
+    """Signed-cookie sessions with a server-side store for anything outside cookie_keys.
+
+    Requests that only touch cookie keys (e.g. /jobs/<id> polling) never
+    read the server store, and each part is written only when its contents
+    actually changed, including changes inside nested lists and dicts.
+    """
+
+    def __init__(self, store, cookie_keys=DEFAULT_COOKIE_KEYS):
+        self.store = store
+        self.cookie_keys = frozenset(cookie_keys)
+
+    def open_session(self, app, request):
+        serializer = self.get_signing_serializer(app)
+        if serializer is None:
+            return None
+        data = {}
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            max_age = int(app.permanent_session_lifetime.total_seconds())
+            try:
+                data = serializer.loads(cookie, max_age=max_age)
+            except Exception:
+                data = {}
+        sid = data.pop(SID_KEY, None)
+        return HybridSession(data, sid, self.store, self.cookie_keys)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        # Server part first: creating a row gives the cookie a session id to carry
+        if session.server_loaded:
+            server_data = session.server_part()
+            if server_data != session.initial_server:
+                if server_data:
+                    if session.sid is None:
+                        session.sid = secrets.token_urlsafe(24)
+                    self.store.save(session.sid, server_data)
+                elif session.sid is not None:
+                    self.store.delete(session.sid)
+                    session.sid = None
+
+        cookie_data = session.cookie_part()
+        if cookie_data == session.initial_cookie and session.sid == session.initial_sid:
+            return
+        if session.sid is not None:
+            cookie_data[SID_KEY] = session.sid
+
+        if not cookie_data:
+            response.delete_cookie(name, domain=domain, path=path,
+                                   secure=self.get_cookie_secure(app),
+                                   httponly=self.get_cookie_httponly(app))
+            return
+
+        response.vary.add("Cookie")
+        response.set_cookie(
+            name,
+            self.get_signing_serializer(app).dumps(cookie_data),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def init_session(app, backend):
+    """Install the session backend selected by SESSION_BACKEND.
+
+    filesystem: Flask-Session files (the original setup)
+    cookie:     Flask's signed cookie for everything, no server state
+    hybrid:     signed cookie for DEFAULT_COOKIE_KEYS plus a SQLite store
+                at SESSION_SQLITE_PATH for everything else
+    """
+    if backend == "filesystem":
+        from flask_session import Session
+        app.config["SESSION_TYPE"] = "filesystem"
+        Session(app)
+    elif backend == "cookie":
+        app.session_interface = SecureCookieSessionInterface()
+    elif backend == "hybrid":
+        store = SQLiteSessionStore(app.config["SESSION_SQLITE_PATH"])
+        app.session_interface = HybridSessionInterface(store)
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
+    logging.info("Using %s session backend", backend)
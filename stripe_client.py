@@ -0,0 +1,171 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+
+# Per-attempt connect/read timeout for Stripe HTTP calls
+STRIPE_TIMEOUT_SECONDS = float(os.environ.get("STRIPE_TIMEOUT", 10))
+
+# Retries on connection errors, 409s and 5xx; the SDK reuses the idempotency key on each one
+STRIPE_MAX_RETRIES = int(os.environ.get("STRIPE_MAX_RETRIES", 2))
+
+# Hard upper bound on how long a request waits for Stripe, retries included
+STRIPE_DEADLINE_SECONDS = float(os.environ.get("STRIPE_DEADLINE", STRIPE_TIMEOUT_SECONDS * (STRIPE_MAX_RETRIES + 1)))
+
+# Stripe calls run on this many threads per worker process, which is also the connection pool size
+STRIPE_MAX_CONCURRENCY = int(os.environ.get("STRIPE_MAX_CONCURRENCY", 16))
+
+# After this many consecutive failures, fail fast for STRIPE_BREAKER_RESET seconds
+STRIPE_BREAKER_THRESHOLD = int(os.environ.get("STRIPE_BREAKER_THRESHOLD", 5))
+STRIPE_BREAKER_RESET_SECONDS = float(os.environ.get("STRIPE_BREAKER_RESET", 30))
+
+_executor = ThreadPoolExecutor(max_workers=STRIPE_MAX_CONCURRENCY, thread_name_prefix="stripe")
+
+# The SDK (and requests) are imported on first use: most requests never touch
+# Stripe, and importing them slows down every worker's startup
+_stripe = None
+_stripe_lock = threading.Lock()
+_settings = {}
+
+
+class StripeUnavailableError(Exception):
+    """Raised when Stripe cannot be reached in time or the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    closed:    calls go through; failures are counted
+    open:      calls fail immediately until reset_timeout has passed
+    half-open: one trial call goes through; success closes the breaker,
+               failure opens it again
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Stripe circuit breaker closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.warning("Stripe circuit breaker opened after %s consecutive failures", self._failures)
+                self._opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(STRIPE_BREAKER_THRESHOLD, STRIPE_BREAKER_RESET_SECONDS)
+
+
+def _build_http_client(stripe):
+    import requests
+
+    # One keep-alive session shared by all call threads, with a pool large
+    # enough that every thread can hold a connection open to Stripe
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_MAX_CONCURRENCY)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return stripe.RequestsClient(timeout=STRIPE_TIMEOUT_SECONDS, session=session)
+
+
+def configure_stripe(api_key, api_base=None):
+    """Set the API key and an optional API base (e.g. a local stub), applied when the SDK is first used"""
+    _settings.update(api_key=api_key, api_base=api_base)
+
+
+def get_stripe():
+    """Return the stripe module, importing it and setting up the shared HTTP client on first use"""
+    global _stripe
+    if _stripe is None:
+        with _stripe_lock:
+            if _stripe is None:
+                import stripe
+                stripe.api_key = _settings.get("api_key")
+                if _settings.get("api_base"):
+                    stripe.api_base = _settings["api_base"]
+                    logging.info("Using Stripe API base %s", _settings["api_base"])
+                stripe.max_network_retries = STRIPE_MAX_RETRIES
+                stripe.default_http_client = _build_http_client(stripe)
+                _stripe = stripe
+    return _stripe
+
+
+def _is_outage(error):
+    # Errors that say Stripe is unreachable or unhealthy, as opposed to a bad request from us
+    stripe = get_stripe()
+    return isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError))
+
+
+def call_stripe(fn, *args, timeout=STRIPE_DEADLINE_SECONDS, **kwargs):
+    """Run a blocking Stripe SDK call off the request thread.
+
+    Fails fast with StripeUnavailableError while the circuit breaker is open,
+    and raises it when the call (including SDK retries) exceeds timeout.
+    """
+    if not breaker.allow():
+        metrics.inc("stripe_requests_total", outcome="circuit_open")
+        raise StripeUnavailableError("Payment processor is temporarily unavailable")
+
+    started = time.perf_counter()
+    future = _executor.submit(fn, *args, **kwargs)
+    try:
+        result = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        breaker.record_failure()
+        metrics.inc("stripe_requests_total", outcome="timeout")
+        raise StripeUnavailableError("Payment processor did not respond in time")
+    except Exception as e:
+        if _is_outage(e):
+            breaker.record_failure()
+            metrics.inc("stripe_requests_total", outcome="error")
+        else:
+            # A rejected request means Stripe itself is healthy
+            breaker.record_success()
+            metrics.inc("stripe_requests_total", outcome="client_error")
+        raise
+    finally:
+        metrics.observe("stripe_request_seconds", time.perf_counter() - started)
+    breaker.record_success()
+    metrics.inc("stripe_requests_total", outcome="ok")
+    return result
+
+
+def checkout_idempotency_key(client_reference_id):
+    """Idempotency key for creating the checkout session tied to client_reference_id"""
+    return f"checkout-{client_reference_id}"
@@ -0,0 +1,16 @@
+import os
+import tempfile
+
+# The app creates its data stores relative to the working directory on import;
+# keep everything the tests write out of the source tree
+_data_dir = tempfile.mkdtemp(prefix="phototool-tests-")
+for name, path in {
+    "SESSION_SQLITE_PATH": os.path.join("sessions", "sessions.db"),
+    "CHECKOUT_CACHE_PATH": os.path.join("sessions", "checkouts.db"),
+    "PAYMENT_STORE_PATH": os.path.join("payments", "payments.db"),
+    "BLOB_STORE_DIR": "blob_store",
+    "PROCESSING_JOBS_DIR": "processing_jobs",
+    "RESULT_CACHE_DIR": "result_cache",
+    "METRICS_DIR": "metrics",
+}.items():
+    os.environ.setdefault(name, os.path.join(_data_dir, path))
@@ -0,0 +1,20 @@
+import threading
+
+import jobs
+
+
+def test_a_job_waits_for_a_free_processing_slot(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "SLOTS_DIR", str(tmp_path))
+    monkeypatch.setattr(jobs, "PROCESSING_SLOTS", 1)
+    held = jobs._acquire_slot()
+
+    acquired = threading.Event()
+    def wait_for_slot():
+        jobs._acquire_slot().close()
+        acquired.set()
+    threading.Thread(target=wait_for_slot, daemon=True).start()
+
+    # flock locks belong to the open file, so this holds even within one process
+    assert not acquired.wait(0.3)
+    held.close()
+    assert acquired.wait(2)
@@ -0,0 +1,132 @@
+import json
+import time
+import secrets
+
+import pytest
+
+import app as app_module
+import jobs
+from benchmarks.stripe_stub import sign_payload
+
+WEBHOOK_SECRET = "whsec_test"
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setitem(app_module.app.config, "STRIPE_WEBHOOK_SECRET", WEBHOOK_SECRET)
+    monkeypatch.setitem(app_module.app.config, "PAYMENT_EVENTS_TIMEOUT_SECONDS", 1)
+    return app_module.app
+
+
+def checkout_event(checkout_session_id, payment_status="paid", event_id=None):
+    return json.dumps({
+        "id": event_id or f"evt_test_{secrets.token_hex(8)}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": checkout_session_id,
+            "object": "checkout.session",
+            "client_reference_id": "ref",
+            "payment_status": payment_status,
+            "amount_total": 299,
+            "currency": "cad",
+        }},
+    }).encode()
+
+
+def post_webhook(client, payload, secret=WEBHOOK_SECRET):
+    return client.post("/stripe-webhook", data=payload, content_type="application/json",
+                       headers={"Stripe-Signature": sign_payload(payload, secret)})
+
+
+def start_checkout(client, checkout_session_id):
+    with client.session_transaction() as session:
+        session["checkout_session_id"] = checkout_session_id
+
+
+def test_bad_signature_is_rejected(app):
+    client = app.test_client()
+    checkout_session_id = f"cs_test_{secrets.token_hex(8)}"
+    response = post_webhook(client, checkout_event(checkout_session_id), secret="whsec_wrong")
+    assert response.status_code == 400
+
+    start_checkout(client, checkout_session_id)
+    assert client.get("/payment-status").get_json()["paid"] is False
+
+
+def test_direct_payment_is_refused_when_webhooks_confirm_payments(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["csrf_token"] = "token"
+    response = client.post("/direct-payment", data={"csrf_token": "token"})
+    assert response.status_code == 404
+    assert client.get("/payment-status").get_json()["paid"] is False
+
+
+def test_paid_checkout_flips_the_session_to_paid(app):
+    client = app.test_client()
+    checkout_session_id = f"cs_test_{secrets.token_hex(8)}"
+    start_checkout(client, checkout_session_id)
+    assert client.get("/payment-status").get_json()["paid"] is False
+
+    # Delayed payment methods complete the checkout before the money arrives
+    assert post_webhook(client, checkout_event(checkout_session_id, payment_status="unpaid")).status_code == 200
+    assert client.get("/payment-status").get_json()["paid"] is False
+
+    assert post_webhook(client, checkout_event(checkout_session_id)).status_code == 200
+    assert client.get("/payment-status").get_json()["paid"] is True
+
+
+def test_duplicate_delivery_is_recorded_once(app, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(app_module.metrics, "inc", lambda name, value=1, **labels: recorded.append(labels.get("outcome")))
+    client = app.test_client()
+    payload = checkout_event(f"cs_test_{secrets.token_hex(8)}")
+
+    assert post_webhook(client, payload).status_code == 200
+    assert post_webhook(client, payload).status_code == 200
+    assert recorded == ["recorded", "duplicate"]
+
+
+def test_payment_events_stream_sends_paid(app):
+    client = app.test_client()
+    checkout_session_id = f"cs_test_{secrets.token_hex(8)}"
+    start_checkout(client, checkout_session_id)
+    post_webhook(client, checkout_event(checkout_session_id))
+
+    body = client.get("/payment-events").get_data(as_text=True)
+    assert "event: paid" in body
+
+
+def test_payment_events_answer_at_once_when_no_stream_slot_is_free(app, monkeypatch):
+    monkeypatch.setattr(app_module, "_payment_streams", app_module.threading.BoundedSemaphore(1))
+    app_module._payment_streams.acquire()
+    client = app.test_client()
+    start_checkout(client, f"cs_test_{secrets.token_hex(8)}")
+
+    started = time.monotonic()
+    body = client.get("/payment-events").get_data(as_text=True)
+    assert time.monotonic() - started < 0.5
+    assert body.startswith(f"retry: {app.config['PAYMENT_EVENTS_BUSY_RETRY_MS']}")
+    assert "event: paid" not in body
+
+
+def test_batch_checkout_charges_only_finished_photos(app, monkeypatch):
+    result = {"image": b"image", "preview": b"preview", "quality": 90, "encodes": 1,
+              "compression_info": {}, "compliance": None}
+    done_job = app_module.create_finished_job(jobs._store_result(result))
+    failed_job, job_dir = jobs._new_job_dir()
+    jobs._write_status(job_dir, {"status": "failed", "error": "Error processing image"})
+
+    quantities = []
+    monkeypatch.setattr(app_module, "create_checkout", lambda reference, quantity=1: quantities.append(quantity)
+                        or {"id": f"cs_test_{secrets.token_hex(8)}", "url": "https://checkout.test"})
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["csrf_token"] = "token"
+        session["batch_id"] = "batch"
+        session["batch_jobs"] = [[done_job, "a.jpg"], [failed_job, "b.jpg"]]
+
+    response = client.post("/create-checkout-session", data={"csrf_token": "token", "batch_id": "batch"})
+    assert response.status_code == 200
+    assert quantities == [1]
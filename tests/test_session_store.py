@@ -0,0 +1,57 @@
+from flask import Flask, flash, get_flashed_messages, jsonify, session
+
+from session_store import HybridSessionInterface, SQLiteSessionStore
+
+
+def make_app(tmp_path):
+    app = Flask(__name__)
+    app.secret_key = "test-secret"
+    app.session_interface = HybridSessionInterface(SQLiteSessionStore(str(tmp_path / "sessions.db")))
+
+    @app.route("/flash/<message>")
+    def add_flash(message):
+        flash(message)
+        return "ok"
+
+    @app.route("/flashes")
+    def flashes():
+        return jsonify(get_flashed_messages())
+
+    @app.route("/jobs/<job_id>")
+    def add_job(job_id):
+        session.setdefault("batch_jobs", []).append(job_id)
+        return jsonify(len(session["batch_jobs"]))
+
+    @app.route("/free-download")
+    def free_download():
+        if session.get("download_count", 0) >= 1:
+            return "payment required", 402
+        session["download_count"] = session.get("download_count", 0) + 1
+        return "ok"
+
+    return app
+
+
+def test_flashes_from_separate_requests_are_kept(tmp_path):
+    client = make_app(tmp_path).test_client()
+    client.get("/flash/one")
+    client.get("/flash/two")
+    assert client.get("/flashes").get_json() == ["one", "two"]
+    assert client.get("/flashes").get_json() == []
+
+
+def test_in_place_changes_to_server_values_are_saved(tmp_path):
+    client = make_app(tmp_path).test_client()
+    lengths = [client.get(f"/jobs/{job_id}").get_json() for job_id in ("a", "b", "c")]
+    assert lengths == [1, 2, 3]
+
+
+def test_replayed_cookie_does_not_restore_a_used_free_download(tmp_path):
+    app = make_app(tmp_path)
+    client = app.test_client()
+    client.get("/jobs/a")
+    cookie_before = client.get_cookie(app.config["SESSION_COOKIE_NAME"]).value
+
+    assert client.get("/free-download").status_code == 200
+    client.set_cookie(app.config["SESSION_COOKIE_NAME"], cookie_before)
+    assert client.get("/free-download").status_code == 402
@@ -0,0 +1,82 @@
+import time
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+import stripe
+from stripe._http_client import HTTPClient
+
+import stripe_client
+from benchmarks.stripe_stub import StripeStubHandler
+from stripe_client import CircuitBreaker, StripeUnavailableError, call_stripe, checkout_idempotency_key
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Stripe stub on a free port, with stripe_client pointed at it and retries not sleeping"""
+    monkeypatch.setattr(StripeStubHandler, "received", [])
+    monkeypatch.setattr(StripeStubHandler, "fail_next", 0)
+    monkeypatch.setattr(StripeStubHandler, "fail_status", 500)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StripeStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Restore the SDK's global settings after the test
+    for name in ("api_key", "api_base", "max_network_retries", "default_http_client"):
+        monkeypatch.setattr(stripe, name, getattr(stripe, name))
+    monkeypatch.setattr(HTTPClient, "INITIAL_DELAY", 0)
+    monkeypatch.setattr(stripe_client, "_stripe", None)
+    monkeypatch.setattr(stripe_client, "_settings", {})
+    monkeypatch.setattr(stripe_client, "breaker", CircuitBreaker(failure_threshold=3, reset_timeout=0.2))
+    stripe_client.configure_stripe("sk_test_stub", f"http://127.0.0.1:{server.server_port}")
+    yield StripeStubHandler
+    server.shutdown()
+    server.server_close()
+
+
+def create_checkout(reference):
+    return call_stripe(
+        stripe_client.get_stripe().checkout.Session.create,
+        mode="payment",
+        client_reference_id=reference,
+        idempotency_key=checkout_idempotency_key(reference),
+    )
+
+
+def test_retries_reuse_the_idempotency_key(stub):
+    stub.fail_next = stripe_client.STRIPE_MAX_RETRIES
+    checkout_session = create_checkout("ref-1")
+
+    assert checkout_session.client_reference_id == "ref-1"
+    assert stub.received == [("/v1/checkout/sessions", "checkout-ref-1")] * (stripe_client.STRIPE_MAX_RETRIES + 1)
+    # Creating it again replays the original session instead of opening a second one
+    assert create_checkout("ref-1").id == checkout_session.id
+
+
+def test_client_errors_are_not_retried(stub):
+    stub.fail_next = 1
+    stub.fail_status = 400
+    with pytest.raises(stripe.InvalidRequestError):
+        create_checkout("ref-2")
+
+    assert len(stub.received) == 1
+    assert stripe_client.breaker.state == "closed"
+
+
+def test_breaker_opens_after_repeated_failures_and_closes_after_cooldown(stub):
+    stub.fail_next = 1000
+    for _ in range(3):
+        with pytest.raises(stripe.APIError):
+            create_checkout("ref-3")
+    assert stripe_client.breaker.state == "open"
+
+    # While open, calls fail fast without reaching Stripe
+    attempts = len(stub.received)
+    with pytest.raises(StripeUnavailableError):
+        create_checkout("ref-3")
+    assert len(stub.received) == attempts
+
+    time.sleep(0.25)
+    assert stripe_client.breaker.state == "half-open"
+    stub.fail_next = 0
+    assert create_checkout("ref-3").client_reference_id == "ref-3"
+    assert stripe_client.breaker.state == "closed"
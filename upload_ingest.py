@@ -0,0 +1,82 @@
+import io
+import tempfile
+
+from flask import Request, current_app
+from PIL import Image
+
+from image_processing import InvalidImageError, validate_image_header
+
+# Extensions whose upload parts are sniffed while they stream in
+SNIFFED_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+
+# JPEG headers can sit behind large EXIF blocks; give up identifying after this much
+DEFAULT_SNIFF_LIMIT = 256 * 1024
+
+# Try to identify the image once the prefix reaches each of these sizes
+SNIFF_CHECKPOINTS = (4 * 1024, 16 * 1024, 64 * 1024)
+
+
+class UploadRejected(Exception):
+    """Raised while the body is still streaming, so the rest is never read.
+
+    Deliberately not a ValueError: Werkzeug silently swallows those during
+    form parsing.
+    """
+
+
+class SniffingUploadStream:
+    """Spooled upload buffer that identifies the image from its first few KB.
+
+    Data stays in memory up to memory_limit bytes and then spills to a temp
+    file. Once the prefix identifies the image, its format and dimensions are
+    validated; an unacceptable upload raises UploadRejected from write(),
+    which aborts multipart parsing before the remaining body is read.
+    """
+
+    def __init__(self, memory_limit, sniff_limit=DEFAULT_SNIFF_LIMIT):
+        self._file = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+        self.sniff_limit = sniff_limit
+        self.sniffed = None
+        self._prefix = bytearray()
+        self._checkpoints = list(SNIFF_CHECKPOINTS) + [sniff_limit]
+
+    def write(self, data):
+        if self.sniffed is None:
+            self._prefix += data
+            if len(self._prefix) >= self._checkpoints[0]:
+                self._sniff()
+        return self._file.write(data)
+
+    def _sniff(self):
+        while self._checkpoints and len(self._prefix) >= self._checkpoints[0]:
+            self._checkpoints.pop(0)
+        try:
+            image = Image.open(io.BytesIO(bytes(self._prefix)))
+        except Exception:
+            # Header not complete yet; keep reading until the sniff limit
+            if len(self._prefix) >= self.sniff_limit:
+                raise UploadRejected("Invalid image file")
+            return
+        try:
+            validate_image_header(image)
+        except InvalidImageError as e:
+            raise UploadRejected(str(e)) from e
+        self.sniffed = {"format": image.format, "width": image.width, "height": image.height}
+        self._prefix = None
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class IngestRequest(Request):
+    """Request that sniffs image uploads while streaming and spools them with a memory cap"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        memory_limit = current_app.config["UPLOAD_MEMORY_LIMIT"]
+        extension = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+        if extension in SNIFFED_EXTENSIONS:
+            return SniffingUploadStream(memory_limit)
+        return tempfile.SpooledTemporaryFile(max_size=memory_limit)